@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from oauth2_provider.oauth2_backends import get_oauthlib_core
+from oauth2_provider.settings import oauth2_settings
+from loguru import logger
+
+from core.api.async_views import AsyncAPIView
+from .serializers import AliceDevicesQuerySerializer, AliceDevicesActionSerializer
+from .services import async_make_alice_device_list, async_parse_devices_query_or_action
+
+
+class AsyncAliceView(AsyncAPIView):
+    """
+    OAuth2 token check as OAuth2Authentication + TokenHasReadWriteScope do (read for GET, write for POST)
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        scope = oauth2_settings.READ_SCOPE if request.method in ('GET', 'HEAD', 'OPTIONS') \
+            else oauth2_settings.WRITE_SCOPE
+        valid, oauth_request = await sync_to_async(get_oauthlib_core().verify_request)(request, scopes=[scope])
+        if not valid:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+        request.user = oauth_request.user
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncGetDevices(AsyncAliceView):
+    http_method_names = ['get']
+
+    async def get(self, request, *args, **kwargs):
+        request_id = request.headers.get('X-Request-Id')
+        if not request_id:
+            return JsonResponse({'message': 'Luk ? Its you ?'}, status=401)
+        rsp = {
+            "request_id": request_id,
+            "payload": {
+                "user_id": f'{request.user.username}_{request.user.id}',
+                "devices": await async_make_alice_device_list()
+            }
+        }
+        return JsonResponse(rsp)
+
+
+class AsyncDevicesQueryOrActionPost(AsyncAliceView):
+    http_method_names = ['post']
+
+    async def post(self, request, *args, **kwargs):
+        logger.info(kwargs)
+        request_id = request.headers.get('X-Request-Id')
+        if not request_id:
+            return JsonResponse({'message': 'Luk ? Its you ?'}, status=401)
+
+        request_type = kwargs.get('request_type')
+        serialized = AliceDevicesQuerySerializer(data=self.request_data(request))
+        if request_type == 'action':
+            serialized = AliceDevicesActionSerializer(data=self.request_data(request))
+
+        if not serialized.is_valid():
+            logger.info(serialized)
+            return JsonResponse({'msg': 'Request format error'}, status=403)
+
+        all_dev_response = {
+            "request_id": request_id,
+            "payload": {
+                "devices": await async_parse_devices_query_or_action(serialized.validated_data, request_type)
+            }
+        }
+        return JsonResponse(all_dev_response)
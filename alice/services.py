@@ -1,38 +1,55 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
 from core.models import MqttTopic
-from core.services.hardware_api import make_hw_api_request
+from core.services.hardware_api import make_hw_api_request, async_make_hw_api_request
+from core.services.deadline import request_deadline, deadline_in
 from django.core.cache import cache
+from decouple import config # noqa
 from loguru import logger
 
+ALICE_DEADLINE = config('ALICE_DEADLINE', default=2.5, cast=float)  # seconds for all devices of the request
+executor = ThreadPoolExecutor(config('ALICE_WORKERS', default=8, cast=int), thread_name_prefix='alice')
 
-def make_alice_device_list() -> list:
-    # Get devices list for request 'GET v1.0/user/devices'
-    summary_list = []
-    for dev_model in MqttTopic.objects.filter(alice=True, alice_data__has_key='type'):
-        device_dict = {
-            'type': dev_model.alice_data.get('type'),
-            'id': dev_model.str_id,
-            'name': dev_model.alice_name,
-            'description': dev_model.description,
-            'room': dev_model.alice_room,
-            'custom_data': {'mqtt': f'{dev_model.group_name}/{dev_model.topic}'},
-            'capabilities': [],
-            'properties': []
-        }
 
-        if all_capabilities := dev_model.alice_data.get('capabilities'):
-            for single_cap_dict in all_capabilities:
-                device_dict['capabilities'].append(single_cap_dict)
+def alice_devices():
+    return MqttTopic.objects.filter(alice=True, alice_data__has_key='type').select_related('group')
+
+
+def alice_device(dev_model: MqttTopic) -> dict:
+    device_dict = {
+        'type': dev_model.alice_data.get('type'),
+        'id': dev_model.str_id,
+        'name': dev_model.alice_name,
+        'description': dev_model.description,
+        'room': dev_model.alice_room,
+        'custom_data': {'mqtt': f'{dev_model.group_name}/{dev_model.topic}'},
+        'capabilities': [],
+        'properties': []
+    }
 
-        if all_properties := dev_model.alice_data.get('properties'):
-            for single_prop_dict in all_properties:
-                device_dict['properties'].append(single_prop_dict)
+    if all_capabilities := dev_model.alice_data.get('capabilities'):
+        for single_cap_dict in all_capabilities:
+            device_dict['capabilities'].append(single_cap_dict)
 
-        summary_list.append(device_dict)
+    if all_properties := dev_model.alice_data.get('properties'):
+        for single_prop_dict in all_properties:
+            device_dict['properties'].append(single_prop_dict)
+
+    return device_dict
+
+
+def make_alice_device_list() -> list:
+    # Get devices list for request 'GET v1.0/user/devices'
+    return [alice_device(dev_model) for dev_model in alice_devices()]
 
-    return summary_list
+
+async def async_make_alice_device_list() -> list:
+    return [alice_device(dev_model) async for dev_model in alice_devices()]
 
 
 def error_handler(dev_id: str) -> dict:
@@ -43,18 +60,31 @@ def error_handler(dev_id: str) -> dict:
         }
 
 
-def devices_properties_float(device_db: MqttTopic, instance: str = None) -> dict:
-    # Get current device state (properties - devices.properties.float)
+def device_status(device_db: MqttTopic) -> dict:
+    # Current device status from cache or from hardware, empty if hardware is not OK
     cache_reply = cache.get(f'{device_db.group_name}/{device_db.topic}')
     if cache_reply:
-        status_reply = cache_reply
-    else:
-        status_reply = make_hw_api_request(device_db, cmd='status')
-        if not status_reply.get('ok'):
-            logger.error(f'Not OK from HW status - {status_reply}')
-            return {}
-        status_reply = status_reply.get('data')
+        return cache_reply
+    status_reply = make_hw_api_request(device_db, cmd='status')
+    if not status_reply.get('ok'):
+        logger.error(f'Not OK from HW status - {status_reply}')
+        return {}
+    return status_reply.get('data')
+
+
+async def async_device_status(device_db: MqttTopic) -> dict:
+    cache_reply = await cache.aget(f'{device_db.group_name}/{device_db.topic}')
+    if cache_reply:
+        return cache_reply
+    status_reply = await async_make_hw_api_request(device_db, cmd='status')
+    if not status_reply.get('ok'):
+        logger.error(f'Not OK from HW status - {status_reply}')
+        return {}
+    return status_reply.get('data')
+
 
+def devices_properties_float(device_db: MqttTopic, status_reply: dict, instance: str = None) -> dict:
+    # Current device state (properties - devices.properties.float)
     if 'status' in status_reply:
         # If this is 'raw' data from relay or input - convert it to format for Alice.
         # 'multiple' - multiplier, custom parameter in Alice settings, if not - then 1,
@@ -67,29 +97,20 @@ def devices_properties_float(device_db: MqttTopic, instance: str = None) -> dict
     return status_reply
 
 
-def device_state_cap_on_off(device_db: MqttTopic) -> dict:
-    # Get current device state (capabilities - devices.capabilities.on_off)
-    cache_reply = cache.get(f'{device_db.group_name}/{device_db.topic}')
-    if cache_reply:
-        logger.info(f"from cache !")
-        status_value = cache_reply.get('status') == 1
-    else:
-        status_reply = make_hw_api_request(device_db, cmd='status')
-        if not status_reply.get('ok'):
-            logger.error(f'Not OK from HW status - {status_reply}')
-            return {}
-        status_value = status_reply.get('data').get('status') == 1
+def device_state_cap_on_off(status_reply: dict) -> dict:
+    # Current device state (capabilities - devices.capabilities.on_off)
     return {
         "instance": "on",
-        "value": status_value
+        "value": status_reply.get('status') == 1
     }
 
 
-def device_action_cap_on_off(device_db: MqttTopic, state: dict) -> dict:
-    # Set new device state (capabilities - devices.capabilities.on_off)
-    command = 'on' if state.get('value') else 'off'
-    status_reply = make_hw_api_request(device_db, cmd=command)
+def on_off_command(state: dict) -> str:
+    return 'on' if state.get('value') else 'off'
+
 
+def device_action_cap_on_off(status_reply: dict) -> dict:
+    # Result of new device state (capabilities - devices.capabilities.on_off)
     action_result = {
         "status": "DONE"
     }
@@ -106,13 +127,14 @@ def device_action_cap_on_off(device_db: MqttTopic, state: dict) -> dict:
     }
 
 
-def query_single_device_state(device_db: MqttTopic):
+def device_configured(device_db: MqttTopic) -> bool:
+    return bool(device_db.alice_data.get('capabilities') or device_db.alice_data.get('properties'))
+
+
+def single_device_state(device_db: MqttTopic, status_reply: dict):
+    # Device state for Alice from its status, empty if there is no status
     devices_capabilities_list = device_db.alice_data.get('capabilities') or []
     devices_properties_list = device_db.alice_data.get('properties') or []
-    if not devices_capabilities_list and not devices_properties_list:
-        # ! В настройках не заданы и не свойства и не умения
-        logger.error('no cap or prop !')
-        return error_handler(device_db.str_id)
 
     return_capabilities = []
     return_properties = []
@@ -123,8 +145,8 @@ def query_single_device_state(device_db: MqttTopic):
         state = {}
         if not devices_capabilities:
             return error_handler(device_db.str_id)
-        if devices_capabilities == 'devices.capabilities.on_off':
-            state = device_state_cap_on_off(device_db)
+        if devices_capabilities == 'devices.capabilities.on_off' and status_reply:
+            state = device_state_cap_on_off(status_reply)
 
         if not state:
             return {}
@@ -141,8 +163,9 @@ def query_single_device_state(device_db: MqttTopic):
         state = {}
         if not devices_properties:
             return error_handler(device_db.str_id)
-        if devices_properties == 'devices.properties.float':
-            state = devices_properties_float(device_db, single_properties.get('parameters').get('instance'))
+        if devices_properties == 'devices.properties.float' and status_reply:
+            state = devices_properties_float(device_db, status_reply,
+                                             single_properties.get('parameters').get('instance'))
 
         if not state:
             return {}
@@ -156,6 +179,21 @@ def query_single_device_state(device_db: MqttTopic):
     return return_capabilities or return_properties
 
 
+def query_single_device_state(device_db: MqttTopic):
+    if not device_configured(device_db):
+        # ! В настройках не заданы и не свойства и не умения
+        logger.error('no cap or prop !')
+        return error_handler(device_db.str_id)
+    return single_device_state(device_db, device_status(device_db))
+
+
+async def async_query_single_device_state(device_db: MqttTopic):
+    if not device_configured(device_db):
+        logger.error('no cap or prop !')
+        return error_handler(device_db.str_id)
+    return single_device_state(device_db, await async_device_status(device_db))
+
+
 def action_single_device(device_db: MqttTopic, receive_capabilities_list) -> list:
     # Get device and list with its abilities, go through all  of them and do what we know
     return_capabilities = []
@@ -163,7 +201,8 @@ def action_single_device(device_db: MqttTopic, receive_capabilities_list) -> lis
         new_state = {}
         devices_capabilities = single_capabilities.get('type')
         if devices_capabilities == 'devices.capabilities.on_off':
-            new_state = device_action_cap_on_off(device_db, single_capabilities.get('state'))
+            status_reply = make_hw_api_request(device_db, cmd=on_off_command(single_capabilities.get('state')))
+            new_state = device_action_cap_on_off(status_reply)
         return_capabilities.append({
             "type": devices_capabilities,
             "state": new_state
@@ -171,39 +210,147 @@ def action_single_device(device_db: MqttTopic, receive_capabilities_list) -> lis
     return return_capabilities
 
 
+async def async_action_single_device(device_db: MqttTopic, receive_capabilities_list) -> list:
+    return_capabilities = []
+    for single_capabilities in receive_capabilities_list:
+        new_state = {}
+        devices_capabilities = single_capabilities.get('type')
+        if devices_capabilities == 'devices.capabilities.on_off':
+            status_reply = await async_make_hw_api_request(
+                device_db, cmd=on_off_command(single_capabilities.get('state')))
+            new_state = device_action_cap_on_off(status_reply)
+        return_capabilities.append({
+            "type": devices_capabilities,
+            "state": new_state
+        })
+    return return_capabilities
+
+
+def root_devices(dev_list: dict, command: str = 'query') -> list:
+    if command == 'action':
+        return dev_list.get('payload').get('devices')
+    return dev_list.get('devices')
+
+
+def device_not_found(device_id: str) -> dict:
+    logger.error(f'Device {device_id} not found in DB')
+    return {
+        "id": device_id,
+        "error_code": "DEVICE_UNREACHABLE",
+        "error_message": "Device not found in DB :("
+    }
+
+
+def device_cap_or_prop(device_db: MqttTopic) -> str:
+    # if device_db.alice_data.get('capabilities'):
+    if device_db.alice_data.get('properties'):
+        return 'properties'
+    return 'capabilities'
+
+
+def device_answer(device_id: str, cap_or_prop: str, cap_or_prop_result) -> dict:
+    if not cap_or_prop_result:
+        logger.info("No result")
+        cap_or_prop = "error_code"
+        cap_or_prop_result = "DEVICE_UNREACHABLE"
+
+    return {
+        "id": device_id,
+        cap_or_prop: cap_or_prop_result
+    }
+
+
+def device_timeout(device_id: str) -> dict:
+    logger.error(f'Device {device_id} did not answer in time')
+    return {
+        "id": device_id,
+        "error_code": "DEVICE_UNREACHABLE",
+        "error_message": "Device did not answer in time :("
+    }
+
+
+def device_call(device: dict, device_db: MqttTopic, command: str):
+    # Blocking (hardware) part of the answer for one device
+    cap_or_prop = device_cap_or_prop(device_db)
+    if command == 'query':
+        return cap_or_prop, query_single_device_state(device_db)
+    return cap_or_prop, action_single_device(device_db, device.get(cap_or_prop))
+
+
+async def async_device_call(device: dict, device_db: MqttTopic, command: str):
+    cap_or_prop = device_cap_or_prop(device_db)
+    if command == 'query':
+        return cap_or_prop, await async_query_single_device_state(device_db)
+    return cap_or_prop, await async_action_single_device(device_db, device.get(cap_or_prop))
+
+
 def parse_devices_query_or_action(dev_list: dict, command: str = 'query') -> list:
+    """
+    All devices are fetched from DB by one query, hardware is asked concurrently. Device which did not
+    answer till the deadline (ALICE_DEADLINE, not later than the request one) is DEVICE_UNREACHABLE.
+    """
+    devices = root_devices(dev_list, command)
+    devices_db = {device_db.str_id: device_db for device_db in MqttTopic.objects.filter(
+        str_id__in=[device['id'] for device in devices], alice=True).select_related('group')}
+
+    deadline = deadline_in(ALICE_DEADLINE)
+    token = request_deadline.set(deadline)  # hardware calls in threads get it with the context copy
+    try:
+        futures = {device['id']: executor.submit(copy_context().run, device_call, device, devices_db[device['id']],
+                                                 command)
+                   for device in devices if device['id'] in devices_db}
+    finally:
+        request_deadline.reset(token)
+    wait(futures.values(), timeout=max(deadline - time.monotonic(), 0))
+
     all_device_state_answer = []
-    root_device_list = dev_list.get('devices')
-    if command == 'action':
-        root_device_list = dev_list.get('payload').get('devices')
+    for device in devices:
+        device_id = device['id']
+        future = futures.get(device_id)
+        if future is None:
+            all_device_state_answer.append(device_not_found(device_id))
+        elif not future.done() or future.exception():
+            if future.done():
+                logger.error(f'Device {device_id} failed - {future.exception()}')
+            all_device_state_answer.append(device_timeout(device_id))
+        else:
+            all_device_state_answer.append(device_answer(device_id, *future.result()))
+
+    return all_device_state_answer
+
+
+async def async_parse_devices_query_or_action(dev_list: dict, command: str = 'query') -> list:
+    """
+    The same as parse_devices_query_or_action for async views
+    """
+    devices = root_devices(dev_list, command)
+    # group is needed for the topic, fetch it now - lazy FK load is not allowed in async code
+    devices_db = {device_db.str_id: device_db async for device_db in MqttTopic.objects.filter(
+        str_id__in=[device['id'] for device in devices], alice=True).select_related('group')}
+
+    deadline = deadline_in(ALICE_DEADLINE)
+    token = request_deadline.set(deadline)  # tasks copy the context with it
+    try:
+        tasks = {device['id']: asyncio.create_task(async_device_call(device, devices_db[device['id']], command))
+                 for device in devices if device['id'] in devices_db}
+    finally:
+        request_deadline.reset(token)
+    if tasks:
+        _, pending = await asyncio.wait(tasks.values(), timeout=max(deadline - time.monotonic(), 0))
+        for task in pending:
+            task.cancel()
 
-    for device in root_device_list:
+    all_device_state_answer = []
+    for device in devices:
         device_id = device['id']
-        device_db = MqttTopic.objects.filter(str_id=device_id, alice=True).first()
-        if not device_db:
-            logger.error(f'Device {device_id} not found in DB')
-            all_device_state_answer.append({
-                "id": device_id,
-                "error_code": "DEVICE_UNREACHABLE",
-                "error_message": "Device not found in DB :("
-            })
-            continue
-
-        # if device_db.alice_data.get('capabilities'):
-        cap_or_prop = 'capabilities'
-        if device_db.alice_data.get('properties'):
-            cap_or_prop = 'properties'
-        cap_or_prop_result = query_single_device_state(device_db) if command == 'query' \
-            else action_single_device(device_db, device.get(cap_or_prop))
-
-        if not cap_or_prop_result:
-            logger.info("No result")
-            cap_or_prop = "error_code"
-            cap_or_prop_result = "DEVICE_UNREACHABLE"
-
-        all_device_state_answer.append({
-            "id": device_id,
-            cap_or_prop: cap_or_prop_result
-        })
+        task = tasks.get(device_id)
+        if task is None:
+            all_device_state_answer.append(device_not_found(device_id))
+        elif not task.done() or task.cancelled() or task.exception():  # cancelled just now is not done yet
+            if task.done() and not task.cancelled():
+                logger.error(f'Device {device_id} failed - {task.exception()}')
+            all_device_state_answer.append(device_timeout(device_id))
+        else:
+            all_device_state_answer.append(device_answer(device_id, *task.result()))
 
     return all_device_state_answer
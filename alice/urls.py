@@ -4,14 +4,21 @@ __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
 from django.urls import path, include
 from .views import RootHead, GetDevices, UnlinkPost, DevicesQueryOrActionPost
+from .async_views import AsyncGetDevices, AsyncDevicesQueryOrActionPost
 import oauth2_provider.views as oauth2_views
+from decouple import config # noqa
+
+# Async hot paths, when served by ASGI (config/asgi.py)
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)
+devices_query_or_action = AsyncDevicesQueryOrActionPost if ASYNC_VIEWS else DevicesQueryOrActionPost
+get_devices = AsyncGetDevices if ASYNC_VIEWS else GetDevices
 
 
 urlpatterns = [
     path('v1.0/user/unlink', UnlinkPost.as_view()),
-    path('v1.0/user/devices/query', DevicesQueryOrActionPost.as_view(), {'request_type': 'query'}),
-    path('v1.0/user/devices/action', DevicesQueryOrActionPost.as_view(), {'request_type': 'action'}),
-    path('v1.0/user/devices', GetDevices.as_view()),
+    path('v1.0/user/devices/query', devices_query_or_action.as_view(), {'request_type': 'query'}),
+    path('v1.0/user/devices/action', devices_query_or_action.as_view(), {'request_type': 'action'}),
+    path('v1.0/user/devices', get_devices.as_view()),
     path('v1.0', RootHead.as_view()),
 
     path('auth/', oauth2_views.AuthorizationView.as_view(), name="auth"),
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import json
+from django.http import JsonResponse
+from django.views import View
+from loguru import logger
+
+from .serializers import RawMqttSerializer
+from ..services.raw_mqtt import async_parse_raw_mqtt
+
+
+class AsyncAPIView(View):
+    """
+    Plain Django async view for the hot paths (DRF views are sync only). Like APIView it is csrf exempt,
+    body is JSON or form data.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    @staticmethod
+    def request_data(request):
+        if request.content_type == 'application/json':
+            try:
+                return json.loads(request.body or b'{}')
+            except ValueError as e:
+                logger.error(f'Cant parse request body to json - {e}')
+                return None
+        return request.POST
+
+
+class AsyncRawMqttPost(AsyncAPIView):
+    http_method_names = ['post']
+    serializer_class = RawMqttSerializer
+
+    async def post(self, request, *args, **kwargs):  # noqa
+        serialized = self.serializer_class(data=self.request_data(request))
+        if not serialized.is_valid():
+            return JsonResponse({'msg': 'Oops'}, status=400)
+
+        return JsonResponse(await async_parse_raw_mqtt(serialized.validated_data))
@@ -6,12 +6,18 @@ from django.contrib import admin
 from django.urls import path, include, re_path
 from django.conf import settings
 from rest_framework import routers
+from decouple import config # noqa
 
-from core.api.viewsets import MqttTopicGet, RcCodeGet, TopicGet, RawMqttPost
+from core.api.viewsets import MqttTopicGet, MqttTopicIndexGet, RcCodeGet, TopicGet, RawMqttPost, RawMqttBatchPost
+from core.api.async_views import AsyncRawMqttPost
+
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)  # async hot paths, when served by ASGI
 
 urlpatterns = [
     path('mqtt/', MqttTopicGet.as_view()),
-    path('rawmqtt/', RawMqttPost.as_view()),
+    path('mqtt/topics/', MqttTopicIndexGet.as_view()),
+    path('rawmqtt/', AsyncRawMqttPost.as_view() if ASYNC_VIEWS else RawMqttPost.as_view()),
+    path('rawmqtt/batch/', RawMqttBatchPost.as_view()),
     re_path('code/(?P<code>.+)/$', RcCodeGet.as_view()),
     re_path('topic/(?P<mqtt>.+)/$', TopicGet.as_view()),
 ]
@@ -2,6 +2,7 @@
 
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
+from loguru import logger
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView, RetrieveAPIView
 from rest_framework.response import Response
@@ -10,8 +11,10 @@ from rest_framework.permissions import AllowAny
 
 from .serializers import MqttTopicSerializer, RcCodeSerializer, RawMqttSerializer
 from core.models import MqttTopic, RcCode
+from ..services.deadline import request_deadline, deadline_from_request
 from ..services.hardware_api import make_hw_api_request
 from ..services.raw_mqtt import parse_raw_mqtt
+from ..services.routing import routing_table
 
 
 class MqttTopicGet(ListAPIView):
@@ -27,6 +30,18 @@ class MqttTopicGet(ListAPIView):
         return queryset
 
 
+class MqttTopicIndexGet(APIView):
+    """
+    Compact list of topics which are routed by RawMqttPost (mqtt-sub subscribes only to them)
+    """
+    permission_classes = [AllowAny]
+    http_method_names = ['get']
+
+    def get(self, request, *args, **kwargs):  # noqa
+        table = routing_table()
+        return Response({'version': table.routable_version, 'topics': table.routable})
+
+
 class RcCodeGet(RetrieveAPIView):
     permission_classes = [AllowAny]
     http_method_names = ['get']
@@ -60,3 +75,35 @@ class RawMqttPost(APIView):
             return Response(mqtt_data)
         # return Response(make_hw_request(mqtt_data.get('data'), serialized.validated_data.get('payload')))
         return Response(mqtt_data)
+
+
+class RawMqttBatchPost(APIView):
+    """
+    Batch of raw MQTT messages [{"topic": ..., "payload": ...}, ...] in one request,
+    items are handled in order, result for every item in the same order.
+    Every item has own deadline, as it was a separate request - slow item must not eat time of the rest.
+    """
+    permission_classes = [AllowAny]
+    http_method_names = ['post']
+    serializer_class = RawMqttSerializer
+    max_items = config('RAW_MQTT_BATCH_MAX', default=100, cast=int)
+
+    def post(self, request, *args, **kwargs):  # noqa
+        if not isinstance(request.data, list) or len(request.data) > self.max_items:
+            return Response({'msg': 'Oops'}, status=400)
+
+        results = []
+        for item in request.data:
+            serialized = self.serializer_class(data=item)
+            if not serialized.is_valid():
+                results.append({'ok': False, 'msg': 'Oops'})
+                continue
+            token = request_deadline.set(deadline_from_request(request))
+            try:
+                results.append(parse_raw_mqtt(serialized.validated_data))
+            except Exception as e:  # one bad message must not lose the rest of the batch
+                logger.error(f'Raw mqtt {item.get("topic")} failed - {e}')
+                results.append({'ok': False, 'msg': str(e)})
+            finally:
+                request_deadline.reset(token)
+        return Response(results)
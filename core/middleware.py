@@ -2,8 +2,11 @@
 
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
+import asyncio
 from django.contrib.auth.middleware import RemoteUserMiddleware
 from django.contrib.auth.backends import RemoteUserBackend
+from django.utils.decorators import sync_and_async_middleware
+from core.services.deadline import request_deadline, deadline_from_request
 
 
 class CustomRemoteUserMiddleware(RemoteUserMiddleware):
@@ -13,3 +16,25 @@ class CustomRemoteUserMiddleware(RemoteUserMiddleware):
 
 class CustomRemoteUserBackend(RemoteUserBackend):
     create_unknown_user = False
+
+
+@sync_and_async_middleware
+def request_deadline_middleware(get_response):
+    """
+    Deadline of the request for hardware calls (see core.services.deadline), works under WSGI and ASGI
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = request_deadline.set(deadline_from_request(request))
+            try:
+                return await get_response(request)
+            finally:
+                request_deadline.reset(token)
+    else:
+        def middleware(request):
+            token = request_deadline.set(deadline_from_request(request))
+            try:
+                return get_response(request)
+            finally:
+                request_deadline.reset(token)
+    return middleware
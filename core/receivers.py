@@ -3,5 +3,20 @@
 __author__ = 'Nikolai Mamashin (mamashin@gmail.com)'
 
 from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete, pre_save, m2m_changed, pre_delete
 from django.dispatch import receiver
+
+from core.models import MqttGroup, MqttTopic, RcCode
+from core.services.routing import invalidate_routing_table
+
+
+@receiver(post_save, sender=MqttGroup)
+@receiver(post_delete, sender=MqttGroup)
+@receiver(post_save, sender=MqttTopic)
+@receiver(post_delete, sender=MqttTopic)
+@receiver(post_save, sender=RcCode)
+@receiver(post_delete, sender=RcCode)
+def routing_changed(sender, **kwargs):
+    # Rebuild after commit - the new table must see the change
+    transaction.on_commit(invalidate_routing_table)
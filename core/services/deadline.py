@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import time
+from contextvars import ContextVar
+from typing import Union
+from decouple import config # noqa
+
+REQUEST_DEADLINE = config('REQUEST_DEADLINE', default=4, cast=float)  # seconds for the whole request
+DEADLINE_HEADER = 'HTTP_X_REQUEST_TIMEOUT'  # caller can tell how long it is ready to wait (seconds)
+
+# Absolute time (time.monotonic) when answer is not needed anymore, set by RequestDeadlineMiddleware
+request_deadline: ContextVar[Union[float, None]] = ContextVar('request_deadline', default=None)
+
+
+def deadline_from_request(request) -> float:
+    timeout = REQUEST_DEADLINE
+    try:
+        timeout = min(float(request.META[DEADLINE_HEADER]), timeout)
+    except (KeyError, ValueError):
+        pass
+    return time.monotonic() + timeout
+
+
+def time_left(timeout: float, deadline: Union[float, None] = None) -> float:
+    """
+    Timeout for the next call: not longer than 'timeout' and not later than deadline of the request
+    (given one or the current request's one). Zero or less - there is no time left.
+    """
+    deadline = deadline if deadline is not None else request_deadline.get()
+    if deadline is None:
+        return timeout
+    return min(timeout, deadline - time.monotonic())
+
+
+def deadline_in(timeout: float) -> float:
+    """
+    Deadline 'timeout' seconds from now, but not later than deadline of the current request
+    """
+    deadline = time.monotonic() + timeout
+    if (current := request_deadline.get()) is not None:
+        return min(deadline, current)
+    return deadline
@@ -1,18 +1,32 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
-import json
+import asyncio
+import os
+import weakref
+from typing import Union
 from core.models import MqttTopic
 from loguru import logger
 import httpx
 from decouple import config # noqa
-import paho.mqtt.publish as publish
 from django.core.cache import cache
+from .mqtt_publisher import mqtt_publisher
+from .deadline import time_left
+
+HW_CTRL_TIMEOUT = config('HW_CTRL_TIMEOUT', default=4, cast=float)  # max for one call to hw-ctrl
+HW_CTRL_LIMITS = httpx.Limits(max_connections=config('HW_CTRL_MAX_CONNECTIONS', default=10, cast=int),
+                              max_keepalive_connections=config('HW_CTRL_MAX_CONNECTIONS', default=10, cast=int))
+
+_client = {'pid': None, 'client': None}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> client (connections belong to the loop)
 
 
 def publish_to_mqtt(topic, payload):
+    """
+    Queue message for the process-wide publisher, does not wait for the broker
+    """
     try:
-        publish.single(topic, payload=json.dumps(payload).encode(), hostname="localhost")
+        mqtt_publisher.publish(topic, payload)
     except Exception as e:
         logger.error(f"Error publish to MQTT broker - {e}")
     return
@@ -22,42 +36,98 @@ def write_to_cache(topic, payload, ttl: int = 360):
     cache.set(topic, payload, ttl)
 
 
-def make_hw_api_request(mqtt_data: MqttTopic, cmd: str = 'status') -> dict:
-    response_status = {'ok': False}
+async def async_write_to_cache(topic, payload, ttl: int = 360):
+    await cache.aset(topic, payload, ttl)
+
+
+def hw_client() -> httpx.Client:
+    """
+    Shared keep-alive client of the process (new one in the forked worker)
+    """
+    if _client['pid'] != os.getpid():
+        _client['client'] = httpx.Client(limits=HW_CTRL_LIMITS, timeout=HW_CTRL_TIMEOUT)
+        _client['pid'] = os.getpid()
+    return _client['client']
+
+
+def async_hw_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = httpx.AsyncClient(limits=HW_CTRL_LIMITS, timeout=HW_CTRL_TIMEOUT)
+    return _async_clients[loop]
 
-    def error_handler(message):
-        logger.error(message)
-        response_status['msg'] = message
-        return response_status
 
+def hw_api_url(mqtt_data: MqttTopic, cmd: str) -> Union[str, None]:
+    if not cmd or cmd not in ['on', 'off', 'toggle', 'status']:
+        return None
     hw_ctrl_api_url = config("HW_CTRL_API_URL")
     base_uri = f'{hw_ctrl_api_url}/{mqtt_data.group_name}'
-    if not cmd or cmd not in ['on', 'off', 'toggle', 'status']:
-        return response_status
     if mqtt_data.group_name in ['relay', 'input']:
         base_uri = f'{base_uri}/{mqtt_data.unit_id}/{mqtt_data.channel}'
     if mqtt_data.group_name in ['w1', 'sensor']:  # If it Wire1 or other sensor
         base_uri = f'{base_uri}/{mqtt_data.topic}'
+    return f'{base_uri}?cmd={cmd}'
 
-    base_uri = f'{base_uri}?cmd={cmd}'
 
-    try:
-        hw_api_response = httpx.get(base_uri, timeout=4, headers={'Connection': 'close'})
-    except Exception as e:
-        return error_handler(f'Unable connect to {base_uri} - {e}')
+def hw_api_error(message: str) -> dict:
+    logger.error(message)
+    return {'ok': False, 'msg': message}
+
+
+def parse_hw_api_response(mqtt_data: MqttTopic, hw_api_response: httpx.Response) -> dict:
     if not str(hw_api_response.status_code).startswith("2"):
-        return error_handler(f"Got response error from MQTT API - {hw_api_response.text}")
+        return hw_api_error(f"Got response error from MQTT API - {hw_api_response.text}")
     try:
         hw_api_response_dict = hw_api_response.json()
     except Exception as e:
-        return error_handler(f"Unable convert response to JSON - {e} ({hw_api_response.text})")
+        return hw_api_error(f"Unable convert response to JSON - {e} ({hw_api_response.text})")
     if hw_api_response_dict.get('error'):
-        return error_handler(f"Что-то не то при запросе ModBus API - {hw_api_response_dict}")
+        return hw_api_error(f"Что-то не то при запросе ModBus API - {hw_api_response_dict}")
 
-    response_status['ok'] = True
-    response_status['data'] = hw_api_response_dict.get('data')
+    response_status = {'ok': True, 'data': hw_api_response_dict.get('data')}
 
     publish_to_mqtt(f'{mqtt_data.group_name}/{mqtt_data.topic}', response_status['data'])
-    write_to_cache(f'{mqtt_data.group_name}/{mqtt_data.topic}', response_status['data'])
 
     return response_status
+
+
+def make_hw_api_request(mqtt_data: MqttTopic, cmd: str = 'status', deadline: Union[float, None] = None) -> dict:
+    """
+    Call hw-ctrl, wait not longer than HW_CTRL_TIMEOUT and the deadline (time.monotonic) -
+    by default the deadline of the current request
+    """
+    base_uri = hw_api_url(mqtt_data, cmd)
+    if not base_uri:
+        return {'ok': False}
+    timeout = time_left(HW_CTRL_TIMEOUT, deadline)
+    if timeout <= 0:
+        return hw_api_error(f'No time left for {base_uri}')
+    try:
+        hw_api_response = hw_client().get(base_uri, timeout=timeout)
+    except Exception as e:
+        return hw_api_error(f'Unable connect to {base_uri} - {e}')
+    response_status = parse_hw_api_response(mqtt_data, hw_api_response)
+    if response_status['ok']:
+        write_to_cache(f'{mqtt_data.group_name}/{mqtt_data.topic}', response_status['data'])
+    return response_status
+
+
+async def async_make_hw_api_request(mqtt_data: MqttTopic, cmd: str = 'status',
+                                    deadline: Union[float, None] = None) -> dict:
+    """
+    The same as make_hw_api_request for async views
+    """
+    base_uri = hw_api_url(mqtt_data, cmd)
+    if not base_uri:
+        return {'ok': False}
+    timeout = time_left(HW_CTRL_TIMEOUT, deadline)
+    if timeout <= 0:
+        return hw_api_error(f'No time left for {base_uri}')
+    try:
+        hw_api_response = await async_hw_client().get(base_uri, timeout=timeout)
+    except Exception as e:
+        return hw_api_error(f'Unable connect to {base_uri} - {e}')
+    response_status = parse_hw_api_response(mqtt_data, hw_api_response)
+    if response_status['ok']:
+        await async_write_to_cache(f'{mqtt_data.group_name}/{mqtt_data.topic}', response_status['data'])
+    return response_status
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import json
+import os
+import queue
+import threading
+import paho.mqtt.client as mqtt
+from loguru import logger
+from decouple import config # noqa
+
+
+class MqttPublisher:
+    """
+    One long-lived connection to the broker per process. Paho network loop runs in its own thread
+    (and reconnects by itself), messages go through the bounded queue and are sent by the sender thread,
+    so request never waits for the broker. Started on the first publish - after the worker is forked.
+    """
+
+    def __init__(self, host: str, port: int = 1883, client_id: str = 'django', queue_size: int = 1000):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.queue_size = queue_size
+        self._pid = None
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._queue = None
+        self._client = None
+
+    def _on_connect(self, client, userdata, flags, rc):  # noqa
+        if rc == 0:
+            self._connected.set()
+        else:
+            logger.error(f'MQTT broker refused connection - {mqtt.connack_string(rc)}')
+
+    def _on_disconnect(self, client, userdata, rc):  # noqa
+        self._connected.clear()
+        if rc != 0:
+            logger.warning(f'Lost connection to MQTT broker ({rc}), reconnecting')
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # New process (or forked worker) - threads of the parent are not here, start our own
+            self._connected = threading.Event()
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._client = mqtt.Client(client_id=f'{self.client_id}-{os.getpid()}', clean_session=True)
+            self._client.on_connect = self._on_connect
+            self._client.on_disconnect = self._on_disconnect
+            self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+            self._client.connect_async(self.host, self.port)
+            self._client.loop_start()
+            threading.Thread(target=self._send, name='mqtt-publisher', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _send(self):
+        client, messages, connected = self._client, self._queue, self._connected
+        while True:
+            topic, payload = messages.get()
+            connected.wait()
+            info = client.publish(topic, payload=payload)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.error(f'Error publish to MQTT broker {topic} - {mqtt.error_string(info.rc)}')
+
+    def publish(self, topic: str, payload: dict):
+        if not self.host:  # MQTT is not configured
+            return
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait((topic, json.dumps(payload).encode()))
+        except queue.Full:
+            logger.warning(f'MQTT queue is full, drop message to {topic}')
+
+
+mqtt_publisher = MqttPublisher(config('MQTT_HOST', default='localhost'), config('MQTT_PORT', default=1883, cast=int),
+                               queue_size=config('MQTT_QUEUE_SIZE', default=1000, cast=int))
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
+from typing import Union
 from loguru import logger
 
-from .hardware_api import make_hw_api_request
+from .hardware_api import make_hw_api_request, async_make_hw_api_request
 from ..api.serializers import RawMqttSerializer
-from core.models import MqttTopic, RcCode
+from .routing import routing_table, async_routing_table, RoutingTable, Route
 from decouple import config  # noqa
 
 DEBUG = config('MQTT_DEBUG', default=False, cast=bool)
@@ -15,24 +16,32 @@ def switch_roll(topic: str):
     """
     If it's roll and command "up" - send "off" to "down" and vice versa
     """
-    switch_topic = f"{topic[:-5]}_up"
-    if topic.endswith("_up"):
-        switch_topic = f"{topic[:-3]}_down"
-    switch_topic_detail = MqttTopic.objects.filter(topic=switch_topic).first()
+    switch_topic_detail = routing_table().roll_pair(topic)
     if DEBUG:
         logger.debug(f"Switch topic detail - {switch_topic_detail}")
     if not switch_topic_detail:
-        logger.error(f"Unable to find topic for switch roll - {switch_topic}")
+        logger.error(f"Unable to find topic for switch roll of {topic}")
         return
     make_hw_api_request(switch_topic_detail, "off")
 
 
-def parse_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data) -> dict:
+async def async_switch_roll(topic: str):
+    switch_topic_detail = (await async_routing_table()).roll_pair(topic)
+    if not switch_topic_detail:
+        logger.error(f"Unable to find topic for switch roll of {topic}")
+        return
+    await async_make_hw_api_request(switch_topic_detail, "off")
+
+
+def resolve_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data, table: RoutingTable) -> Union[tuple, dict]:
+    """
+    Topic and command of the message - (Route, cmd), or response with error
+    """
     response_status = {'ok': False}
     if DEBUG:
         logger.debug(mqtt_data)
     request_topic = mqtt_data['topic']
-    topic_db_data = MqttTopic.objects.filter(topic=request_topic).first()
+    topic_db_data = table.topic(request_topic)  # in-memory, no DB queries here
     cmd = 'status'  # default
 
     if request_topic == 'rc_code':
@@ -41,11 +50,10 @@ def parse_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data) -> dict:
             logger.error('No RC code in payload data')
             return response_status
         raw_code = mqtt_data.get('payload').get('data')
-        rc_code_data = RcCode.objects.filter(code=raw_code).first()
-        if not rc_code_data:
+        topic_db_data = table.rc_code(raw_code)
+        if topic_db_data is None:
             logger.info(f'RC code "{raw_code}" not found..')
             return response_status
-        topic_db_data = rc_code_data.topic
         cmd = "toggle"
 
     if request_topic != 'rc_code':
@@ -54,13 +62,6 @@ def parse_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data) -> dict:
             return response_status
         cmd = mqtt_data.get('payload').get('cmd')
 
-    if '/' in request_topic:
-        # If topic looks like 'relay/room_main_right_light'
-        split_topic = request_topic.split('/')
-        request_topic = split_topic[1]
-        request_group = split_topic[0]
-        topic_db_data = MqttTopic.objects.filter(topic=request_topic, group__group=request_group).first()
-
     if not topic_db_data:
         response_status['msg'] = 'Topic not found'
         return response_status
@@ -72,7 +73,20 @@ def parse_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data) -> dict:
             response_status['msg'] = msg
             return response_status
 
-    if topic_db_data.topic.startswith('roll_') and cmd in ['on', 'toggle']:
+    return topic_db_data, cmd
+
+
+def need_switch_roll(topic_db_data: Route, cmd: str) -> bool:
+    return topic_db_data.topic.startswith('roll_') and cmd in ['on', 'toggle']
+
+
+def parse_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data) -> dict:
+    resolved = resolve_raw_mqtt(mqtt_data, routing_table())
+    if isinstance(resolved, dict):
+        return resolved
+    topic_db_data, cmd = resolved
+
+    if need_switch_roll(topic_db_data, cmd):
         switch_roll(topic_db_data.topic)
 
     result_hw_api_request = make_hw_api_request(topic_db_data, cmd)
@@ -80,3 +94,22 @@ def parse_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data) -> dict:
         logger.warning(result_hw_api_request)
 
     return result_hw_api_request
+
+
+async def async_parse_raw_mqtt(mqtt_data: RawMqttSerializer.validated_data) -> dict:
+    """
+    The same as parse_raw_mqtt for async views
+    """
+    resolved = resolve_raw_mqtt(mqtt_data, await async_routing_table())
+    if isinstance(resolved, dict):
+        return resolved
+    topic_db_data, cmd = resolved
+
+    if need_switch_roll(topic_db_data, cmd):
+        await async_switch_roll(topic_db_data.topic)  # the other direction is off before this one is on
+
+    result_hw_api_request = await async_make_hw_api_request(topic_db_data, cmd)
+    if DEBUG:
+        logger.warning(result_hw_api_request)
+
+    return result_hw_api_request
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import hashlib
+import threading
+import time
+from types import MappingProxyType
+from typing import NamedTuple, Union
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from loguru import logger
+from decouple import config # noqa
+
+from core.models import MqttTopic, RcCode
+
+VERSION_KEY = 'routing_table_version'
+VERSION_CHECK_INTERVAL = config('ROUTING_VERSION_CHECK', default=1, cast=float)  # seconds between Redis checks
+
+
+class Route(NamedTuple):
+    """
+    What hardware API needs from MqttTopic (the same attribute names), without DB access
+    """
+    topic: str
+    group_name: str
+    unit_id: Union[int, None]
+    channel: Union[int, None]
+    str_id: str
+
+
+def roll_pair_topic(topic: str) -> str:
+    """
+    Pair of the roll: "roll_x_up" <-> "roll_x_down"
+    """
+    if topic.endswith("_up"):
+        return f"{topic[:-3]}_down"
+    return f"{topic[:-5]}_up"
+
+
+class RoutingTable:
+    """
+    Immutable lookup tables for parse_raw_mqtt: topic, group/topic, RC code and roll pair -> Route
+    """
+
+    def __init__(self, version: Union[int, None] = None):
+        self.version = version
+        topics = {}
+        for topic in MqttTopic.objects.select_related('group'):
+            topics[topic.topic] = Route(topic.topic, topic.group_name, topic.unit_id, topic.channel, topic.str_id)
+        self.topics = MappingProxyType(topics)
+        self.rc_codes = MappingProxyType({
+            code: topics.get(topic) for code, topic in RcCode.objects.values_list('code', 'topic__topic')})
+        self.roll_pairs = MappingProxyType({
+            name: topics.get(roll_pair_topic(name)) for name in topics if name.startswith('roll_')})
+        routable = {'rc_code'}
+        for name, route in topics.items():
+            routable.add(name)
+            if route.group_name != 'None':
+                routable.add(f'{route.group_name}/{name}')
+        self.routable = tuple(sorted(routable))
+        self.routable_version = hashlib.md5('\n'.join(self.routable).encode()).hexdigest()[:12]
+
+    def topic(self, request_topic: str) -> Union[Route, None]:
+        """
+        Topic as is or 'group/topic' (topic of this group only)
+        """
+        if '/' not in request_topic:
+            return self.topics.get(request_topic)
+        group, topic = request_topic.split('/')[:2]
+        route = self.topics.get(topic)
+        if route and route.group_name == group:
+            return route
+        return None
+
+    def rc_code(self, code: Union[str, int]) -> Union[Route, None]:
+        """
+        rc-mqtt sends code as number, RcCode.code is a string
+        """
+        return self.rc_codes.get(str(code))
+
+    def roll_pair(self, topic: str) -> Union[Route, None]:
+        return self.roll_pairs.get(topic)
+
+
+_table = {'table': None, 'checked': 0.0}
+_lock = threading.Lock()
+
+
+def shared_version() -> Union[int, None]:
+    try:
+        return cache.get(VERSION_KEY)
+    except Exception as e:
+        logger.error(f'Unable get routing table version - {e}')
+        return None
+
+
+def rebuild_routing_table(version: Union[int, None] = None) -> RoutingTable:
+    with _lock:
+        table = RoutingTable(version)
+        _table['table'] = table  # readers get old or new table, never a half built one
+        _table['checked'] = time.monotonic()
+    logger.info(f'Routing table is built, version {version}, {len(table.topics)} topics')
+    return table
+
+
+def routing_table() -> RoutingTable:
+    """
+    Current table. Version in Redis is checked not often than VERSION_CHECK_INTERVAL,
+    table is rebuilt if other worker changed the topics.
+    """
+    table = _table['table']
+    if table is None:
+        return rebuild_routing_table(shared_version())
+    if time.monotonic() - _table['checked'] > VERSION_CHECK_INTERVAL:
+        _table['checked'] = time.monotonic()
+        version = shared_version()
+        if version != table.version:
+            return rebuild_routing_table(version)
+    return table
+
+
+def invalidate_routing_table():
+    """
+    Topics are changed: new version for all workers and new table for this one
+    """
+    version = None
+    try:
+        cache.add(VERSION_KEY, 0, None)  # no-op if version exists
+        version = cache.incr(VERSION_KEY)
+    except Exception as e:
+        logger.error(f'Unable increment routing table version - {e}')
+    rebuild_routing_table(version)
+
+
+async def async_routing_table() -> RoutingTable:
+    """
+    The same for async views, goes to a thread only when Redis check or rebuild is due
+    """
+    table = _table['table']
+    if table is None or time.monotonic() - _table['checked'] > VERSION_CHECK_INTERVAL:
+        return await sync_to_async(routing_table)()
+    return table
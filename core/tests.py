@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from types import SimpleNamespace
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from core.models import MqttGroup, MqttTopic, RcCode
+from core.services import routing
+from core.services.deadline import REQUEST_DEADLINE, request_deadline, deadline_from_request, deadline_in, time_left
+from core.services.routing import RoutingTable, invalidate_routing_table, routing_table
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class DeadlineTest(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('core.services.deadline.time', SimpleNamespace(monotonic=self.clock.monotonic))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_time_left(self):
+        self.assertEqual(time_left(2), 2)  # no request deadline
+        self.assertEqual(time_left(2, deadline=1001), 1)
+        self.assertEqual(time_left(2, deadline=999), -1)
+        token = request_deadline.set(1000.5)
+        try:
+            self.assertEqual(time_left(2), 0.5)
+            self.assertEqual(deadline_in(10), 1000.5)
+            self.assertEqual(deadline_in(0.2), 1000.2)
+        finally:
+            request_deadline.reset(token)
+        self.assertEqual(deadline_in(10), 1010)
+
+    def test_deadline_from_request(self):
+        factory = RequestFactory()
+        self.assertEqual(deadline_from_request(factory.get('/')), 1000 + REQUEST_DEADLINE)
+        self.assertEqual(deadline_from_request(factory.get('/', HTTP_X_REQUEST_TIMEOUT='1.5')), 1001.5)
+        self.assertEqual(deadline_from_request(factory.get('/', HTTP_X_REQUEST_TIMEOUT='100')), 1000 + REQUEST_DEADLINE)
+        self.assertEqual(deadline_from_request(factory.get('/', HTTP_X_REQUEST_TIMEOUT='soon')), 1000 + REQUEST_DEADLINE)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RoutingTableTest(TestCase):
+    def setUp(self):
+        relay = MqttGroup.objects.create(group='relay')
+        MqttTopic.objects.create(group=relay, topic='light_hall', unit_id=1, channel=3)
+        MqttTopic.objects.create(group=relay, topic='roll_kitchen_up', unit_id=1, channel=4)
+        MqttTopic.objects.create(group=relay, topic='roll_kitchen_down', unit_id=1, channel=5)
+        MqttTopic.objects.create(topic='no_group')
+        RcCode.objects.create(code='1234567', topic=MqttTopic.objects.get(topic='light_hall'))
+
+    def test_lookups(self):
+        table = RoutingTable()
+        self.assertEqual(table.topic('light_hall'), ('light_hall', 'relay', 1, 3, table.topic('light_hall').str_id))
+        self.assertEqual(table.topic('relay/light_hall').channel, 3)
+        self.assertIsNone(table.topic('input/light_hall'))  # topic of other group
+        self.assertIsNone(table.topic('unknown'))
+        self.assertEqual(table.rc_code(1234567).topic, 'light_hall')  # rc-mqtt sends number
+        self.assertEqual(table.rc_code('1234567').topic, 'light_hall')
+        self.assertIsNone(table.rc_code(7654321))
+        self.assertEqual(table.roll_pair('roll_kitchen_up').topic, 'roll_kitchen_down')
+        self.assertEqual(table.roll_pair('roll_kitchen_down').topic, 'roll_kitchen_up')
+
+    def test_routable(self):
+        table = RoutingTable()
+        self.assertEqual(table.routable, ('light_hall', 'no_group', 'rc_code', 'relay/light_hall',
+                                          'relay/roll_kitchen_down', 'relay/roll_kitchen_up', 'roll_kitchen_down',
+                                          'roll_kitchen_up'))
+        self.assertEqual(RoutingTable().routable_version, table.routable_version)
+        MqttTopic.objects.create(topic='new_topic')
+        self.assertNotEqual(RoutingTable().routable_version, table.routable_version)
+
+    def test_rebuilt_on_new_version(self):
+        invalidate_routing_table()
+        table = routing_table()
+        self.assertIs(routing_table(), table)  # version is checked not often than VERSION_CHECK_INTERVAL
+        MqttTopic.objects.create(topic='new_topic')
+        invalidate_routing_table()  # other worker
+        routing._table['checked'] = 0.0
+        self.assertIsNone(table.topic('new_topic'))
+        self.assertEqual(routing_table().topic('new_topic').topic, 'new_topic')
+
+
+class RawMqttBatchDeadlineTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('core.services.deadline.time', SimpleNamespace(monotonic=self.clock.monotonic))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_every_item_has_own_deadline(self):
+        left = []
+
+        def parse_raw_mqtt(mqtt_data):  # hw-ctrl answers in 0.3 s
+            left.append(time_left(10))
+            self.clock.now += 0.3
+            return {'ok': True, 'data': mqtt_data['topic']}
+
+        items = [{'topic': f'relay_{num}', 'payload': {'cmd': 'on'}} for num in range(20)]
+        with mock.patch('core.api.viewsets.parse_raw_mqtt', parse_raw_mqtt):
+            response = self.client.post('/api/rawmqtt/batch/', items, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['data'] for result in response.json()], [item['topic'] for item in items])
+        self.assertEqual(left, [REQUEST_DEADLINE] * 20)
+
+    def test_caller_timeout_is_per_item(self):
+        left = []
+
+        def parse_raw_mqtt(mqtt_data):
+            left.append(time_left(10))
+            self.clock.now += 0.3
+            return {'ok': True}
+
+        with mock.patch('core.api.viewsets.parse_raw_mqtt', parse_raw_mqtt):
+            self.client.post('/api/rawmqtt/batch/', [{'topic': 'relay_1'}] * 3, content_type='application/json',
+                             HTTP_X_REQUEST_TIMEOUT='0.5')
+        self.assertEqual(left, [0.5] * 3)
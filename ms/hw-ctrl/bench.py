@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of hw-ctrl API against Modbus simulator (see simulator.py).
+Application is driven in-process through ASGI transport, so only hw-ctrl and the bus are measured:
+    python bench.py --requests 200 --concurrency 8 --timing auto --latency 0.01
+"""
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from statistics import quantiles
+
+from simulator import add_arguments, simulator_from_args
+
+SCENARIOS = {
+    'relay_status': lambda num: '/relay/1/1',
+    'relay_toggle': lambda num: f'/relay/1/{num % 16 + 1}?cmd=toggle',
+    'relay_board': lambda num: '/relay/1',
+    'input': lambda num: f'/input/2/{num % 16 + 1}',
+    'pzem': lambda num: '/pzem',
+}
+
+
+async def run_scenario(client, name: str, requests: int, concurrency: int) -> dict:
+    make_url = SCENARIOS[name]
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for num in counter:
+            started = time.perf_counter()
+            response = await client.get(make_url(num))
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200 or response.json().get('error'):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    percentiles = quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {'scenario': name, 'requests': requests, 'errors': errors, 'p50_ms': percentiles[49] * 1000,
+            'p99_ms': percentiles[98] * 1000, 'cmd_per_sec': requests / elapsed}
+
+
+async def main(args: argparse.Namespace) -> int:
+    """
+    Run scenarios, result - number of failed requests (non 200 or error in answer)
+    """
+    import httpx
+    import hw_ctrl  # imported after environment is prepared, hw-ctrl reads config on import
+
+    errors = 0
+    await hw_ctrl.app.router.startup()
+    try:
+        async with httpx.AsyncClient(app=hw_ctrl.app, base_url='http://hw-ctrl', timeout=30) as client:
+            print(f"{'scenario':<14}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'cmd/s':>10}")
+            for name in args.scenarios:
+                result = await run_scenario(client, name, args.requests, args.concurrency)
+                errors += result['errors']
+                print(f"{result['scenario']:<14}{result['requests']:>10}{result['errors']:>8}"
+                      f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['cmd_per_sec']:>10.1f}")
+    finally:
+        await hw_ctrl.app.router.shutdown()
+    return errors
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='hw-ctrl benchmark against Modbus simulator')
+    add_arguments(arg_parser)
+    arg_parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    arg_parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+    arg_parser.add_argument('--timing', default='fixed', help='MODBUS_TIMING of hw-ctrl (fixed|auto)')
+    arg_parser.add_argument('--state-max-age', default='0', help='STATE_MAX_AGE of hw-ctrl, 0 - always read the bus')
+    arg_parser.add_argument('--scenarios', nargs='*', default=list(SCENARIOS), choices=list(SCENARIOS))
+    bench_args = arg_parser.parse_args()
+
+    simulator = simulator_from_args(bench_args).start()
+    os.environ.update({
+        'MODBUS_SERIAL': simulator.port,
+        'MODBUS_BUSES': f'main={simulator.port}:9600:N:1',
+        'MODBUS_TIMING': bench_args.timing,
+        'STATE_MAX_AGE': bench_args.state_max_age,
+        'PZEM_UNIT_ID': str(bench_args.pzem[0] if bench_args.pzem else 5),
+        'PZEM_SAMPLE_INTERVAL': '0',
+        'POLL_RELAY_UNITS': '',
+        'POLL_INPUT_UNITS': '',
+        'MQTT_HOST': '',
+    })
+    failed = asyncio.run(main(bench_args))
+    simulator.stop()
+    # Numbers of a run with failed requests measure errors, not the bus - fail loudly (e.g. 404 of missing endpoint)
+    sys.exit(1 if failed and not bench_args.error_rate and not bench_args.drop_rate else 0)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Iterable, Union
+from loguru import logger
+
+
+class BoardState:
+    """
+    In-memory table with the last known state of every board: (kind, unit_id) -> {'status': [...], 'ts': ...}
+    """
+
+    def __init__(self, on_change: Union[Callable[[str, int, int, int, float], None], None] = None):
+        self.boards = {}
+        self.on_change = on_change
+
+    def update(self, kind: str, unit_id: int, status: list) -> list:
+        """
+        Save new board snapshot, return list of changed channels (numbers start from 1)
+        """
+        ts = time.time()
+        previous = self.boards.get((kind, unit_id))
+        self.boards[(kind, unit_id)] = {'status': list(status), 'ts': ts}
+        if previous is None:
+            return []  # first snapshot, nothing to compare with
+        changed = [num for num, (old, new) in enumerate(zip(previous['status'], status), start=1) if old != new]
+        if self.on_change:
+            for channel in changed:
+                self.on_change(kind, unit_id, channel, status[channel - 1], ts)
+        return changed
+
+    def get(self, kind: str, unit_id: int, max_age: float) -> Union[dict, None]:
+        board = self.boards.get((kind, unit_id))
+        if board is None or time.time() - board['ts'] > max_age:
+            return None
+        return board
+
+    def channel(self, kind: str, unit_id: int, channel: int, max_age: float) -> Union[dict, None]:
+        board = self.get(kind, unit_id, max_age)
+        if board is None or not 1 <= channel <= len(board['status']):
+            return None
+        return {'status': board['status'][channel - 1], 'ts': board['ts']}
+
+
+class BoardPoller:
+    """
+    Read all configured boards by the cycle. read_board saves the snapshot to BoardState itself,
+    so the poller only keeps it fresh.
+    """
+
+    def __init__(self, read_board: Callable[[str, int], Awaitable[dict]], boards: Iterable[tuple],
+                 interval: float = 1):
+        self.read_board = read_board
+        self.boards = list(boards)
+        self.interval = interval
+        self._worker = None
+
+    async def start(self):
+        if self.boards:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+
+    async def _poll(self, kind: str, unit_id: int):
+        try:
+            await self.read_board(kind, unit_id)
+        except Exception as e:
+            logger.error(f'Poll {kind} {unit_id} failed - {e}')
+
+    async def _run(self):
+        while True:
+            # All boards at once - boards on different buses are read in parallel, each bus keeps own order
+            await asyncio.gather(*[self._poll(kind, unit_id) for kind, unit_id in self.boards])
+            await asyncio.sleep(self.interval)
+
+
+class InputWatcher:
+    """
+    Fast poll of input boards: every cycle the whole input block is read, packed to bitmask and compared
+    with the previous one, every changed bit is reported as rising/falling edge with timestamp
+    """
+
+    def __init__(self, read_board: Callable[[str, int], Awaitable[dict]], units: Iterable[int],
+                 on_edge: Callable[[int, int, str, float], None], interval: float = 0.05):
+        self.read_board = read_board
+        self.units = list(units)
+        self.on_edge = on_edge
+        self.interval = interval
+        self.masks = {}  # unit_id -> inputs bitmask, bit 0 is channel 1
+        self._workers = []
+
+    async def start(self):
+        self._workers = [asyncio.create_task(self._watch(unit_id)) for unit_id in self.units]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+
+    def check(self, unit_id: int, status: list, ts: float):
+        mask = sum(1 << num for num, value in enumerate(status) if value)
+        previous = self.masks.get(unit_id)
+        self.masks[unit_id] = mask
+        if previous is None:
+            return
+        changed = mask ^ previous
+        while changed:
+            bit = changed & -changed  # lowest changed bit
+            self.on_edge(unit_id, bit.bit_length(), 'rising' if mask & bit else 'falling', ts)
+            changed ^= bit
+
+    async def _watch(self, unit_id: int):
+        while True:
+            try:
+                result = await self.read_board('input', unit_id)
+            except Exception as e:
+                logger.error(f'Watch input {unit_id} failed - {e}')
+                result = {'error': True}
+            if not result['error']:
+                self.check(unit_id, result['status'], time.time())
+            await asyncio.sleep(self.interval)
@@ -2,19 +2,25 @@
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
 import asyncio
+import time
+from functools import partial
 from pathlib import Path
 from fastapi import FastAPI, Response, status
-from typing import Union
-from serial_asyncio import create_serial_connection
-from pymodbus.client.asynchronous.async_io import ModbusClientProtocol
-from pymodbus.transaction import ModbusRtuFramer
-from pymodbus.factory import ClientDecoder
+from fastapi.responses import PlainTextResponse
+from typing import Awaitable, Callable, Dict, Union
+from pydantic import BaseModel
 from loguru import logger
 from decouple import config # noqa
-from aiofile import LineReader, AIOFile
-from os.path import exists as file_exist
 from smbus2_asyncio import SMBus2Asyncio
-from sensors import sensor_sht3x, sensor_light
+from sensors import sensor_read, find_sensor, i2c_bus, SENSORS
+from modbus_bus import BusRegistry, BusClient, PRIORITY_WRITE, PRIORITY_READ, PRIORITY_BACKGROUND
+from mqtt_pub import MqttPublisher
+from board_state import BoardState, BoardPoller, InputWatcher
+from singleflight import SingleFlight
+from pzem import PzemSampler, PERIODS
+from metrics import metrics
+from sensor_schedule import SensorSchedule, parse_schedule
+from wire1 import Wire1
 
 BASE_DIR = Path(__file__).resolve(strict=True).parent
 logger.remove()
@@ -30,6 +36,54 @@ descr = """
 
 app = FastAPI(description=descr)
 DEBUG = config('DEBUG', default=False, cast=bool)
+RELAY_BASE_REG = 0  # relay channel N is holding register N
+INPUT_BASE_REG = 128  # input channel N is holding register 128 + N
+BOARD_CHANNELS = config('BOARD_CHANNELS', default=16, cast=int)
+RELAY_CMD = {'on': 0x0100, 'off': 0x0200, 'toggle': 0x0300}  # value written to channel register
+RELAY_ALL_ON, RELAY_ALL_OFF = 0x0700, 0x0800  # value written to register 0 - all channels at once
+RELAY_ALL_CMD = config('RELAY_ALL_CMD', default=True, cast=bool)  # board supports "all on/all off" commands
+RELAY_MULTI_WRITE = config('RELAY_MULTI_WRITE', default=True, cast=bool)  # board supports func 16 (write registers)
+STATE_MAX_AGE = config('STATE_MAX_AGE', default=5, cast=float)  # older board snapshot is read from the bus again
+MQTT_PREFIX = config('MQTT_PREFIX', default='hw')
+PZEM_UNIT_ID = config('PZEM_UNIT_ID', default=5, cast=int)
+MODBUS_SERIAL = config('MODBUS_SERIAL', default='/dev/ttyUSB0')
+buses = BusRegistry(config('MODBUS_BUSES', default=f"main={MODBUS_SERIAL}:{config('MODBUS_BAUDRATE', default=9600)}:N:1"),
+                    config('MODBUS_UNITS', default=''),
+                    timing=config('MODBUS_TIMING', default='fixed'),
+                    background_max_wait=config('BUS_BACKGROUND_MAX_WAIT', default=2, cast=float),
+                    breaker_failures=config('BREAKER_FAILURES', default=3, cast=int),
+                    breaker_backoff=config('BREAKER_BACKOFF', default=1, cast=float),
+                    breaker_backoff_max=config('BREAKER_BACKOFF_MAX', default=60, cast=float))
+mqtt = MqttPublisher(config('MQTT_HOST', default=''))
+single_flight = SingleFlight()
+
+
+def csv_units(value: str) -> list:
+    return [int(unit) for unit in value.split(',') if unit.strip()]
+
+
+def publish_change(kind: str, unit_id: int, channel: int, value: int, ts: float):
+    mqtt.publish(f'{MQTT_PREFIX}/{kind}/{unit_id}/{channel}', {'status': value, 'ts': ts})
+
+
+def publish_edge(unit_id: int, channel: int, edge: str, ts: float):
+    mqtt.publish(f'{MQTT_PREFIX}/input/{unit_id}/{channel}/edge',
+                 {'edge': edge, 'status': int(edge == 'rising'), 'ts': ts})
+
+
+board_state = BoardState(on_change=publish_change)
+
+
+async def measured(bus_name: str, sensor: str, read: Callable[[], Awaitable[dict]]) -> dict:
+    """
+    Read 1-Wire/I2C sensor and account time and errors
+    """
+    started = time.perf_counter()
+    result = await read()
+    metrics.observe('sensor_read_seconds', time.perf_counter() - started, bus=bus_name, sensor=sensor)
+    if result.get('error'):
+        metrics.inc('sensor_errors_total', bus=bus_name, sensor=sensor)
+    return result
 
 
 def format_result(res: dict) -> dict:
@@ -39,10 +93,10 @@ def format_result(res: dict) -> dict:
     return result
 
 
-async def modbus_pzem(client: ModbusClientProtocol):
+async def modbus_pzem(client: BusClient, unit_id: int = 5):
     result = {'error': True}
     try:
-        read_register = await client.read_input_registers(0, 8, unit=5)
+        read_register = await client.read_input_registers(0, 8, unit=unit_id)
         if read_register.isError():
             return result
         data = {
@@ -60,71 +114,278 @@ async def modbus_pzem(client: ModbusClientProtocol):
         return result
 
 
-async def modbus(client: ModbusClientProtocol, unit_id: int = 1, channel: int = 1, cmd_type: str = 'read',
-                 cmd_set: str = 'on'):
+async def modbus_board(client: BusClient, unit_id: int = 1, base_reg: int = RELAY_BASE_REG) -> dict:
+    """
+    Read state of all channels of the board by one transaction (block of holding registers)
+    """
     result = {'error': True}
-    if cmd_type == 'read' or cmd_set == 'status':
-        try:
-            read_register = await client.read_holding_registers(channel, 1, unit=unit_id)
-            if read_register.isError():
-                return result
-            result['status'] = read_register.registers[0]
-            result['error'] = False
-            return result
-        except Exception as e:
-            logger.error(e)
+    try:
+        read_register = await client.read_holding_registers(base_reg + 1, BOARD_CHANNELS, unit=unit_id)
+        if read_register.isError():
             return result
+    except Exception as e:
+        logger.error(e)
+        return result
+    result['status'] = read_register.registers[:BOARD_CHANNELS]
+    result['error'] = False
+    return result
+
 
-    if cmd_type == 'write':
-        base_reg = 256
-        if cmd_set == 'off':
-            base_reg = 512
-        if cmd_set == 'toggle':
-            base_reg = 768
+async def modbus(client: BusClient, unit_id: int = 1, channel: int = 1, cmd_type: str = 'read',
+                 cmd_set: str = 'on', base_reg: int = RELAY_BASE_REG):
+    result = {'error': True}
+    if cmd_type == 'write' and cmd_set != 'status':
+        base_cmd = RELAY_CMD.get(cmd_set, RELAY_CMD['on'])
         try:
-            write_register = await client.write_register(channel, base_reg, unit=unit_id)
+            write_register = await client.write_register(base_reg + channel, base_cmd, unit=unit_id)
             if write_register.isError():
                 return result
-            await asyncio.sleep(0.1)
-            read_register = await client.read_holding_registers(channel, 1, unit=unit_id)
-            if read_register.isError():
-                return result
         except Exception as e:
             logger.error(e)
             return result
 
-        result['status'] = read_register.registers[0]
-        result['error'] = False
+    # Channel state is taken from the whole board snapshot
+    return board_channel(await modbus_board(client, unit_id, base_reg), channel)
+
+
+def board_channel(board: dict, channel: int) -> dict:
+    result = {'error': True}
+    if board['error'] or not 1 <= channel <= len(board['status']):
         return result
+    result['status'] = board['status'][channel - 1]
+    result['board'] = board['status']
+    result['error'] = False
+    return result
 
 
-def make_protocol():
-    return ModbusClientProtocol(framer=ModbusRtuFramer(ClientDecoder()), timeout=0.7) # noqa
+async def modbus_bulk(client: BusClient, unit_id: int, channels: Dict[int, str]) -> dict:
+    """
+    Set many relay channels of one board: "all on/all off" if it is possible, otherwise write
+    contiguous channels by one "write multiple registers", at the end - one block read for check
+    """
+    result = {'error': True}
+    commands = {channel: RELAY_CMD[cmd] for channel, cmd in sorted(channels.items())}
+    try:
+        all_cmd = set(commands.values())
+        if RELAY_ALL_CMD and len(commands) == BOARD_CHANNELS and all_cmd in ({RELAY_CMD['on']}, {RELAY_CMD['off']}):
+            all_value = RELAY_ALL_ON if all_cmd == {RELAY_CMD['on']} else RELAY_ALL_OFF
+            writes = [(0, [all_value])]
+        elif RELAY_MULTI_WRITE:
+            writes = []
+            for channel, value in commands.items():
+                if writes and writes[-1][0] + len(writes[-1][1]) == channel:
+                    writes[-1][1].append(value)
+                else:
+                    writes.append((channel, [value]))
+        else:
+            writes = [(channel, [value]) for channel, value in commands.items()]
+        for start, values in writes:
+            if len(values) == 1:
+                write_register = await client.write_register(RELAY_BASE_REG + start, values[0], unit=unit_id)
+            else:
+                write_register = await client.write_registers(RELAY_BASE_REG + start, values, unit=unit_id)
+            if write_register.isError():
+                return result
+    except Exception as e:
+        logger.error(e)
+        return result
 
+    board = await modbus_board(client, unit_id, RELAY_BASE_REG)
+    if board['error']:
+        return result
+    result['status'] = board['status']
+    # Channels which are not in requested state after write (toggle can not be checked)
+    result['failed'] = [channel for channel, cmd in channels.items() if cmd != 'toggle' and
+                        channel <= len(board['status']) and board['status'][channel - 1] != (cmd == 'on')]
+    result['error'] = bool(result['failed'])
+    return result
 
-async def serial(unit_id: int = 1, channel: int = 1, cmd_type: str = 'read', cmd_set: Union[str, None] = None):
-    result = []
-    stop_bits = 1
-    loop = asyncio.get_event_loop()
-    if cmd_type == 'pzem':
-        stop_bits = 2
-    serial_coro, protocol = await create_serial_connection(loop,  make_protocol, config('MODBUS_SERIAL'), baudrate=9600,
-                                                           stopbits=stop_bits, timeout=0.1)
+
+async def read_board(kind: str, unit_id: int, priority: int = PRIORITY_READ, save: bool = True) -> dict:
+    """
+    Whole board in one transaction, snapshot is saved to the state table (changed channels are published)
+    """
+    result = await serial(unit_id, cmd_type='board', base_reg=INPUT_BASE_REG if kind == 'input' else RELAY_BASE_REG,
+                          priority=priority)
+    if save and not result['error']:
+        board_state.update(kind, unit_id, result['status'])
+    return result
+
+
+def channel_result(kind: str, unit_id: int, channel: int, result: dict) -> dict:
+    """
+    Save board snapshot from the transaction result to the state table and format answer
+    """
+    board = result.pop('board', None)
+    if board is not None:
+        board_state.update(kind, unit_id, board)
+    if not result['error']:
+        result['channel'] = channel
+        result['unit_id'] = unit_id
+    return format_result(result)
+
+
+async def serial(unit_id: int = 1, channel: int = 1, cmd_type: str = 'read', cmd_set: Union[str, dict, None] = None,
+                 base_reg: int = RELAY_BASE_REG, priority: int = PRIORITY_READ):
+    result = {'error': True}
+    stop_bits = None
+    key = None  # reads with the same key are coalesced into one bus transaction
+    bus = buses.for_unit(unit_id)
     if cmd_type == 'pzem':
-        modbus_cmd = asyncio.create_task(modbus_pzem(protocol))
+        bus = buses.for_unit('pzem')
+        if not buses.has_own_bus('pzem'):  # PZEM shares the relay bus - switch it to 2 stop bits for this job
+            stop_bits = 2
+        key = (bus.port, unit_id, 'input', 0, 8)
+
+        async def job(client: BusClient):
+            return await modbus_pzem(client, unit_id)
+    elif cmd_type == 'bulk':
+        async def job(client: BusClient):
+            return await modbus_bulk(client, unit_id, cmd_set)
+    elif cmd_type in ['board', 'read']:
+        # interactive read must not join background read waiting in the low priority lane
+        key = (bus.port, unit_id, 'holding', base_reg + 1, BOARD_CHANNELS, priority == PRIORITY_BACKGROUND)
+
+        async def job(client: BusClient):
+            return await modbus_board(client, unit_id, base_reg)
     else:
-        modbus_cmd = asyncio.create_task(modbus(protocol, unit_id, channel, cmd_type, cmd_set))
+        async def job(client: BusClient):
+            return await modbus(client, unit_id, channel, cmd_type, cmd_set, base_reg)
+    if cmd_type in ['write', 'bulk']:
+        priority = PRIORITY_WRITE
+    if bus.breaker_state(int(unit_id)) == 'open':  # fail fast, do not even queue the job
+        return {'error': True, 'breaker': 'open'}
+    try:
+        if key:
+            result = await single_flight.do(key, lambda: bus.execute(job, stop_bits, priority))
+        else:
+            result = await bus.execute(job, stop_bits, priority)
+    except Exception as e:
+        logger.error(e)
+        return result
+
+    if cmd_type == 'read':
+        result = board_channel(result, channel)
+    result['breaker'] = bus.breaker_state(int(unit_id))
+    return result
 
-    done, pending = await asyncio.wait({modbus_cmd})
-    if modbus_cmd in done:
-        result = modbus_cmd.result()
-    serial_coro.close()
+
+poller = BoardPoller(partial(read_board, priority=PRIORITY_BACKGROUND),
+                     [('relay', unit) for unit in csv_units(config('POLL_RELAY_UNITS', default=''))] +
+                     [('input', unit) for unit in csv_units(config('POLL_INPUT_UNITS', default=''))],
+                     interval=config('POLL_INTERVAL', default=1, cast=float))
+# Watcher publishes edges itself - its reads do not go to the state table, otherwise every edge is published twice
+input_watcher = InputWatcher(partial(read_board, priority=PRIORITY_BACKGROUND, save=False),
+                             csv_units(config('INPUT_WATCH_UNITS', default='')), publish_edge,
+                             interval=config('INPUT_WATCH_INTERVAL', default=0.05, cast=float))
+
+
+@app.get("/bus")
+async def bus_stats():
+    """
+    Queue depth and wait time (seconds) of every priority lane and unit breakers, per bus
+    :return:
+    {
+        "error": false,
+        "data": {
+            "main": {
+                "write": {"depth": 0, "jobs": 12, "wait_avg": 0.004, "wait_max": 0.03},
+                "read": {...},
+                "background": {...},
+                "breakers": {"3": {"state": "open", "failures": 5}}
+            }
+        }
+    }
+    """
+    return {'error': False, 'data': buses.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_text():
+    """
+    Bus, Modbus and sensor metrics in Prometheus text format
+    """
+    return metrics.render()
+
+
+@app.get("/relay/{unit_id}")
+async def relay_board(unit_id: int):
+    """
+    State of all relay channels of the board (one Modbus transaction)
+    :return:
+     {
+        "error": false,
+        "data": {
+            "status": [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+            "unit_id": 1
+                }
+    }
+    """
+    if DEBUG:
+        logger.info(f'Relay board - {unit_id=}')
+    result = await read_board('relay', unit_id)
+    if not result['error']:
+        result['unit_id'] = unit_id
+
+    return format_result(result)
+
+
+@app.get("/input/{unit_id}")
+async def input_board(unit_id: int):
+    """
+    State of all inputs of the board (one Modbus transaction), format same as /relay/{unit_id}
+    """
+    if DEBUG:
+        logger.info(f'Input board - {unit_id=}')
+    result = await read_board('input', unit_id)
+    if not result['error']:
+        result['unit_id'] = unit_id
+
+    return format_result(result)
+
+
+class RelayBulk(BaseModel):
+    units: Dict[int, Dict[int, str]]
+
+
+@app.post("/relay/bulk")
+async def relay_bulk(request: RelayBulk):
+    """
+    Set many relays by one request, one bus job per board
+    :param request:
+    {
+        "units": {"1": {"1": "on", "2": "off", "3": "toggle"}, "2": {"5": "off"}}
+    }
+    :return:
+    {
+        "error": false,
+        "data": {
+            "1": {"error": false, "data": {"status": [1, 0, 1, 0, ...], "failed": []}},
+            "2": {"error": false, "data": {"status": [0, 0, 0, 0, ...], "failed": []}}
+        }
+    }
+    """
+    if DEBUG:
+        logger.info(f'Relay bulk - {request.units}')
+    for unit_id, channels in request.units.items():
+        for channel, cmd in channels.items():
+            if cmd not in RELAY_CMD or not 1 <= channel <= BOARD_CHANNELS:
+                return {'error': True, 'data': {'msg': f'Wrong command for unit {unit_id} channel {channel}'}}
+
+    units_result = await asyncio.gather(*[serial(unit_id, cmd_type='bulk', cmd_set=channels)
+                                          for unit_id, channels in request.units.items()])
+    result = {'error': False, 'data': {}}
+    for unit_id, unit_result in zip(request.units, units_result):
+        if 'status' in unit_result:
+            board_state.update('relay', unit_id, unit_result['status'])
+        result['error'] = result['error'] or unit_result['error']
+        result['data'][unit_id] = format_result(unit_result)
 
     return result
 
 
 @app.get("/relay/{unit_id}/{channel}")
-async def relay_on_off(unit_id: int, channel: Union[int, str], cmd: Union[str, None] = None):
+async def relay_on_off(unit_id: int, channel: int, cmd: Union[str, None] = None):
     """
     :param unit_id: ModBus Unit ID
     :param channel: Номер реле
@@ -142,18 +403,16 @@ async def relay_on_off(unit_id: int, channel: Union[int, str], cmd: Union[str, N
         logger.info(f'{unit_id=}, {channel=}, {cmd=}')
     result = {}
     cmd_type = 'read'
-    if cmd:
+    if cmd and cmd != 'status':
         cmd_type = 'write'
+    if cmd_type == 'read' and (cached := board_state.channel('relay', unit_id, channel, STATE_MAX_AGE)):
+        return channel_result('relay', unit_id, channel, {'error': False, **cached})
     serial_open = asyncio.create_task(serial(unit_id, channel, cmd_type, cmd))
     done, pending = await asyncio.wait({serial_open})
-    await asyncio.sleep(0.1)
     if serial_open in done:
         result = serial_open.result()
-    if not result['error']:
-        result['channel'] = channel
-        result['unit_id'] = unit_id
 
-    return format_result(result)
+    return channel_result('relay', unit_id, channel, result)
 
 
 @app.get("/input/{unit_id}/{channel}")
@@ -162,16 +421,19 @@ async def input_read(unit_id: int, channel: int):
     cmd_type = 'read'
     if DEBUG:
         logger.info(f'Input - {unit_id=}, {channel=}')
-    serial_open = asyncio.create_task(serial(unit_id, channel + 128, cmd_type))
+    if cached := board_state.channel('input', unit_id, channel, STATE_MAX_AGE):
+        return channel_result('input', unit_id, channel, {'error': False, **cached})
+    serial_open = asyncio.create_task(serial(unit_id, channel, cmd_type, base_reg=INPUT_BASE_REG))
     done, pending = await asyncio.wait({serial_open})
-    await asyncio.sleep(0.1)
     if serial_open in done:
         result = serial_open.result()
-    if not result['error']:
-        result['channel'] = channel
-        result['unit_id'] = unit_id
 
-    return format_result(result)
+    return channel_result('input', unit_id, channel, result)
+
+
+pzem_sampler = PzemSampler(lambda: serial(PZEM_UNIT_ID, cmd_type='pzem', priority=PRIORITY_BACKGROUND),
+                           interval=config('PZEM_SAMPLE_INTERVAL', default=1, cast=float),
+                           size=config('PZEM_HISTORY_SIZE', default=21600, cast=int))
 
 
 @app.get("/pzem")
@@ -187,14 +449,48 @@ async def read_pzem():
             "energy": 81}
     }
     """
+    if latest := pzem_sampler.fresh():
+        return {'error': False, 'data': latest}
     result = {}
-    serial_open = asyncio.create_task(serial(config('PZEM_UNIT_ID'), 1, 'pzem'))
+    serial_open = asyncio.create_task(serial(PZEM_UNIT_ID, 1, 'pzem'))
     done, pending = await asyncio.wait({serial_open})
     if serial_open in done:
         result = serial_open.result()
     return result
 
 
+@app.get("/pzem/history")
+async def pzem_history(period: str = '1m', span: Union[int, None] = None):
+    """
+    PZEM rollups from the background sampler
+    :param period: 1m|5m|1h - bucket size
+    :param span: only last 'span' seconds of history (all history by default)
+    :return:
+    {
+        "error": false,
+        "data": {
+            "energy_wh": 12.4,
+            "rollups": [
+                {"ts": 1690000020.0, "samples": 60, "energy_wh": 0.12,
+                 "voltage": {"min": 11.8, "max": 11.9, "avg": 11.86},
+                 "amp": {...}, "power": {...}}
+            ]
+        }
+    }
+    """
+    if period not in PERIODS:
+        return {'error': True, 'data': {'msg': f'Period must be one of {", ".join(PERIODS)}'}}
+    return {'error': False, 'data': {'energy_wh': round(pzem_sampler.energy_wh, 3),
+                                     'rollups': pzem_sampler.rollups(PERIODS[period], span)}}
+
+
+sensor_schedule = SensorSchedule(parse_schedule(config('SENSOR_SCHEDULE', default='')),
+                                 default_period=config('SENSOR_PERIOD', default=60, cast=float),
+                                 default_max_age=config('SENSOR_MAX_AGE', default=120, cast=float))
+wire1 = Wire1(max_age=config('W1_BULK_MAX_AGE', default=5, cast=float),
+              list_ttl=config('W1_LIST_TTL', default=60, cast=float))
+
+
 @app.get("/w1/{device_id}")
 async def wire1_read(device_id: str):
     """ Read 1Wire Dallas temp
@@ -206,58 +502,96 @@ async def wire1_read(device_id: str):
         "instance": "temperature"
       }
     } """
-    result = {'error': True}
-    cnt = 1
     if DEBUG:
         logger.info(f"W1 Get request {device_id}")
-    # async with AIOFile(f"/tmp/mytemp", 'r') as f:
-    """
-    Wire1 info file looks like:
-     #cat /sys/bus/w1/devices/28-0215635abeff/w1_slave 
-     9e 01 4b 46 7f ff 0c 10 8a : crc=8a YES
-     9e 01 4b 46 7f ff 0c 10 8a t=25875
-    """
-    w1_file_path = f"/sys/bus/w1/devices/{device_id}/w1_slave"
-    if not file_exist(w1_file_path):
+    if device_id not in sensor_schedule.sensors and device_id not in wire1.devices():
         logger.error(f"w1 device not found - {device_id}")
-        return format_result(result)
-    async with AIOFile(w1_file_path, 'r') as f:
-        async for line in LineReader(f):
-            if cnt == 1 and not str(line).strip().endswith("YES"):
-                logger.error(f"File temp info is corrupt - {str(line)}")
-                break
-            if cnt == 2:
-                try:
-                    ll = str(line)
-                    temp = int(ll[ll.find('t=') + 2:])
-                    # result['device_id'] = device_id
-                    result['value'] = float(f'{temp/1000:.1f}')
-                    result['instance'] = "temperature"
-                    result['error'] = False
-                except Exception as e:
-                    logger.error(f"Error to convert temp - {e}")
-                    break
-            cnt += 1
-            if cnt >= 3:
-                break
-    return format_result(result)
+        return {'error': True}
+    sensor_schedule.add(device_id, lambda: wire1_measure(device_id))  # discovered device joins the schedule
+    return await sensor_schedule.get(device_id)
+
+
+@app.get("/w1")
+async def wire1_read_all():
+    """ Read all 1Wire Dallas temp sensors at once (one bulk conversion)
+    {
+      "error": false,
+      "data": {
+        "28-xxx": {"error": false, "data": {"value": 25.7, "instance": "temperature"}},
+        "28-yyy": {"error": false, "data": {"value": 21.2, "instance": "temperature"}},
+        "age": 1.2
+      }
+    } """
+    sensor_schedule.add('w1', wire1_measure_all)
+    return await sensor_schedule.get('w1')
+
+
+async def wire1_measure(device_id: str) -> dict:
+    return format_result(await measured('w1', device_id, lambda: wire1.read(device_id)))
+
+
+async def wire1_measure_all() -> dict:
+    async def read_all():
+        devices = await wire1.read_all()
+        return {'error': not devices,
+                'data': {device_id: format_result(result) for device_id, result in devices.items()}}
+    return await measured('w1', 'bulk', read_all)
+
+
+def i2c_read(sensor_type: str) -> Callable[[], Awaitable[dict]]:
+    return lambda: measured('i2c', sensor_type, lambda: sensor_read(sensor_type, use_cache=False))
 
 
 @app.get("/sensor/{sensor_type}")
 async def sensor_request(sensor_type: str):
+    """
+    Sensor value from memory, 'age' - seconds since measurement
+    {
+      "error": false,
+      "data": {
+        "value": 23.4,
+        "instance": "temperature",
+        "age": 12.3
+      }
+    }
+    """
     result = {'error': True}
-    if 'sht3x_humidity' in sensor_type:
-        return await sensor_sht3x(request_type='humidity')
-    if 'sht3x_temp' in sensor_type:
-        return await sensor_sht3x(request_type='temp')
-    if 'light' in sensor_type:
-        return await sensor_light()
+    if name := find_sensor(sensor_type):  # only registered I2C sensors
+        sensor_schedule.add(name, i2c_read(name))
+        return await sensor_schedule.get(name)
     return result
 
 
 @app.on_event("startup")
 async def startup_event():
-    pass
+    for key in sensor_schedule.schedule:
+        if key == 'w1':
+            sensor_schedule.add(key, wire1_measure_all)
+        elif key in SENSORS:
+            sensor_schedule.add(key, i2c_read(key))
+        else:
+            sensor_schedule.add(key, lambda device_id=key: wire1_measure(device_id))
+    await sensor_schedule.start()
+    await buses.start()
+    try:
+        await i2c_bus.open()
+    except Exception as e:
+        logger.error(f'Unable open I2C bus - {e}')  # not fatal, will try again on the first sensor request
+    await mqtt.start()
+    await poller.start()
+    await input_watcher.start()
+    await pzem_sampler.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await sensor_schedule.stop()
+    await pzem_sampler.stop()
+    await input_watcher.stop()
+    await poller.stop()
+    await mqtt.stop()
+    await buses.stop()
+    await i2c_bus.close()
 
 # import ctypes as ct
 # ct.c_int16(4995).value / 100
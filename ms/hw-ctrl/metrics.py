@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+from bisect import bisect_left
+from typing import Callable
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Very small in-process metrics registry. Hot path is a dict lookup and a couple of additions,
+    text in Prometheus exposition format is rendered only on /metrics request.
+    """
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # name -> callable returning {labels: value}
+        self.help = {}
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, collect: Callable[[], dict]):
+        self.gauges[name] = collect
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+    def _header(self, lines: list, name: str, metric_type: str):
+        if name in self.help:
+            lines.append(f'# HELP {name} {self.help[name]}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted({name for name, _ in self.histograms}):
+            self._header(lines, name, 'histogram')
+            for (metric, labels), histogram in self.histograms.items():
+                if metric != name:
+                    continue
+                cumulative = 0
+                for le, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+        for name in sorted({name for name, _ in self.counters}):
+            self._header(lines, name, 'counter')
+            for (metric, labels), value in self.counters.items():
+                if metric == name:
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+        for name, collect in self.gauges.items():
+            self._header(lines, name, 'gauge')
+            for labels, value in collect().items():
+                lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('modbus_transaction_seconds', 'Modbus transaction time by bus, unit and function code')
+metrics.describe('modbus_errors_total', 'Failed Modbus transactions by type (timeout|crc|exception|io)')
+metrics.describe('modbus_queue_wait_seconds', 'Time job waits in the bus queue by priority class')
+metrics.describe('modbus_bus_busy_seconds_total', 'Time bus worker spent executing jobs')
+metrics.describe('modbus_queue_depth', 'Jobs waiting in the bus queue by priority class')
+metrics.describe('sensor_read_seconds', 'Sensor read time by bus (w1|i2c) and sensor')
+metrics.describe('sensor_errors_total', 'Failed sensor reads by bus (w1|i2c) and sensor')
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Union
+from serial_asyncio import create_serial_connection
+from pymodbus.client.asynchronous.async_io import ModbusClientProtocol
+from pymodbus.transaction import ModbusRtuFramer
+from pymodbus.factory import ClientDecoder
+from loguru import logger
+from metrics import metrics
+
+
+PRIORITY_WRITE, PRIORITY_READ, PRIORITY_BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = ('interactive_write', 'interactive_read', 'background')
+
+
+class BusError(Exception):
+    pass
+
+
+class UnitUnreachable(BusError):
+    pass
+
+
+def make_protocol():
+    return ModbusClientProtocol(framer=ModbusRtuFramer(ClientDecoder()), timeout=0.7) # noqa
+
+
+class BusClient:
+    """
+    Thin wrapper over the protocol given to bus jobs. Every frame goes through _transact, where
+    we keep the silent interval between frames, set response timeout and learn unit latency.
+    Frame sizes are RTU sizes (with address and CRC).
+    """
+
+    def __init__(self, bus: 'ModbusBus'):
+        self.bus = bus
+
+    async def _transact(self, unit: int, fc: int, request_len: int, response_len: int, call: Callable[[], Awaitable],
+                        probe: bool = False):
+        bus = self.bus
+        if not probe and bus.breaker_state(unit) == 'open':
+            raise UnitUnreachable(f'Unit {unit} on bus {bus.name} is unreachable')
+        loop = asyncio.get_running_loop()
+        if (gap := bus.last_frame + bus.frame_gap() - loop.time()) > 0:
+            await asyncio.sleep(gap)
+        bus.protocol._timeout = bus.response_timeout(unit, request_len, response_len)  # noqa
+        started = loop.time()
+        try:
+            response = await call()
+        except Exception as e:
+            error_type = 'io'
+            if isinstance(e, asyncio.TimeoutError):
+                error_type = 'timeout'
+            elif 'crc' in str(e).lower():
+                error_type = 'crc'
+            metrics.inc('modbus_errors_total', bus=bus.name, unit=unit, fc=fc, type=error_type)
+            bus.record_result(unit, False)
+            await bus.discard_pending(unit, started)
+            raise
+        finally:
+            bus.last_frame = loop.time()
+            metrics.observe('modbus_transaction_seconds', bus.last_frame - started, bus=bus.name, unit=unit, fc=fc)
+        bus.record_result(unit, True)  # even Modbus exception response means the unit is alive
+        if response.isError():
+            metrics.inc('modbus_errors_total', bus=bus.name, unit=unit, fc=fc, type='exception')
+        else:
+            bus.learn_latency(unit, bus.last_frame - started - bus.frame_time(request_len + response_len))
+        return response
+
+    async def probe(self, unit: int) -> bool:
+        try:
+            await self._transact(unit, 3, 8, 7, lambda: self.bus.protocol.read_holding_registers(0, 1, unit=unit),
+                                 probe=True)
+        except Exception: # noqa
+            return False
+        return True
+
+    async def read_holding_registers(self, address: int, count: int = 1, unit: int = 1):
+        return await self._transact(unit, 3, 8, 5 + 2 * count,
+                                    lambda: self.bus.protocol.read_holding_registers(address, count, unit=unit))
+
+    async def read_input_registers(self, address: int, count: int = 1, unit: int = 1):
+        return await self._transact(unit, 4, 8, 5 + 2 * count,
+                                    lambda: self.bus.protocol.read_input_registers(address, count, unit=unit))
+
+    async def write_register(self, address: int, value: int, unit: int = 1):
+        return await self._transact(unit, 6, 8, 8,
+                                    lambda: self.bus.protocol.write_register(address, value, unit=unit))
+
+    async def write_registers(self, address: int, values: list, unit: int = 1):
+        return await self._transact(unit, 16, 9 + 2 * len(values), 8,
+                                    lambda: self.bus.protocol.write_registers(address, values, unit=unit))
+
+
+class ModbusBus:
+    """
+    Owner of the RS-485 line. Serial port is opened once and kept open, all transactions are put
+    to the queue and executed strictly one by one by the single worker (no interleaved frames).
+    If port is lost (USB adapter unplugged etc.) - it will be reopened before the next job.
+
+    Timing:
+     * fixed - legacy, 0.1 s between frames and 0.7 s response timeout
+     * auto - silent interval is 3.5 chars at current serial settings, response timeout is calculated from
+       frame sizes plus latency learned for every unit, but not shorter than half of the configured timeout
+
+    Jobs are queued by priority: interactive write, interactive read, background (polling etc.).
+    Worker always takes the most important job, so interactive job waits only for the job on the bus and
+    interactive jobs before it. Background job which waits longer than background_max_wait goes first
+    (one at a time) - background work is never starved completely.
+
+    Every unit has circuit breaker: after breaker_failures failed transactions in a row the unit is marked
+    unreachable and all its transactions fail immediately (other boards do not wait its timeouts).
+    Unit is probed in background with exponential backoff and is closed again on the first answer.
+    """
+
+    def __init__(self, port: str, baudrate: int = 9600, stopbits: int = 1, parity: str = 'N',
+                 timing: str = 'fixed', timeout: float = 0.7, reconnect_delay: float = 2,
+                 background_max_wait: float = 2, name: Union[str, None] = None, breaker_failures: int = 3,
+                 breaker_backoff: float = 1, breaker_backoff_max: float = 60):
+        self.port = port
+        self.name = name or port
+        self.baudrate = baudrate
+        self.stopbits = stopbits
+        self.parity = parity
+        self.timing = timing
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self.background_max_wait = background_max_wait
+        self.breaker_failures = breaker_failures
+        self.breaker_backoff = breaker_backoff
+        self.breaker_backoff_max = breaker_backoff_max
+        self.breakers = {}  # unit_id -> {'failures': ..., 'open': ..., 'backoff': ..., 'next_probe': ...}
+        self.transport = None
+        self.protocol = None
+        self.client = BusClient(self)
+        self.last_frame = 0
+        self.latency = {}  # unit_id -> learned response latency (EWMA), seconds
+        self.lanes = [deque() for _ in PRIORITY_NAMES]
+        self.waits = [{'jobs': 0, 'wait_avg': 0.0, 'wait_max': 0.0} for _ in PRIORITY_NAMES]
+        self._ready = None  # asyncio.Event, created in start() - on the loop which serves requests
+        self._worker = None
+        self._prober = None
+
+    def frame_time(self, size: float) -> float:
+        """
+        Time on the wire for 'size' bytes: start bit + 8 data bits + parity + stop bits per char
+        """
+        stopbits = self.transport.serial.stopbits if self.connected else self.stopbits
+        return size * (1 + 8 + (self.parity != 'N') + stopbits) / self.baudrate
+
+    def frame_gap(self) -> float:
+        if self.timing != 'auto':
+            return 0.1
+        if self.baudrate > 19200:  # fixed value from Modbus RTU spec for high baud rates
+            return 0.00175
+        return self.frame_time(3.5)
+
+    def response_timeout(self, unit: int, request_len: int, response_len: int) -> float:
+        """
+        Learned latency only stretches the timeout for slow units, it is never shorter than half of configured one -
+        one slow answer of a fast unit must not become a timeout
+        """
+        if self.timing != 'auto' or unit not in self.latency:
+            return self.timeout
+        wire = self.frame_time(request_len + response_len)
+        return min(self.timeout, max(self.timeout / 2, wire + self.latency[unit] * 3))
+
+    def learn_latency(self, unit: int, latency: float):
+        latency = max(latency, 0)
+        previous = self.latency.get(unit)
+        self.latency[unit] = latency if previous is None else previous * 0.8 + latency * 0.2
+
+    async def discard_pending(self, unit: int, started: float):
+        """
+        After timeout or broken frame: forget the request and everything received. RTU transactions are
+        keyed by unit id, so late answer must not resolve the next request to the same unit - the line is
+        kept silent till the configured timeout is over (late answer is already here) and then flushed.
+        """
+        if (late := started + self.timeout - asyncio.get_running_loop().time()) > 0:
+            await asyncio.sleep(late)
+        if self.protocol is not None:
+            self.protocol.transaction.delTransaction(unit)
+            self.protocol.framer.resetFrame()
+        if self.connected:
+            try:
+                self.transport.serial.reset_input_buffer()
+            except Exception as e:
+                logger.error(f'Unable reset input buffer of {self.port} - {e}')
+
+    def breaker_state(self, unit: int) -> str:
+        breaker = self.breakers.get(unit)
+        return 'open' if breaker and breaker['open'] else 'closed'
+
+    def record_result(self, unit: int, ok: bool):
+        breaker = self.breakers.get(unit)
+        if breaker is None:
+            breaker = self.breakers[unit] = {'failures': 0, 'open': False, 'backoff': self.breaker_backoff,
+                                             'next_probe': 0}
+        if ok:
+            if breaker['open']:
+                logger.info(f'Unit {unit} on bus {self.name} is reachable again')
+            breaker.update(failures=0, open=False, backoff=self.breaker_backoff)
+            return
+        breaker['failures'] += 1
+        if not breaker['open'] and breaker['failures'] >= self.breaker_failures:
+            logger.warning(f'Unit {unit} on bus {self.name} is unreachable, breaker is open')
+            breaker.update(open=True, next_probe=asyncio.get_running_loop().time() + breaker['backoff'])
+
+    async def _probe_units(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(0.5)
+            for unit, breaker in list(self.breakers.items()):
+                if not breaker['open'] or breaker['next_probe'] > loop.time():
+                    continue
+                try:
+                    reachable = await self.execute(lambda client, probe_unit=unit: client.probe(probe_unit),
+                                                   priority=PRIORITY_BACKGROUND)
+                except Exception: # noqa
+                    reachable = False
+                if not reachable:
+                    breaker['backoff'] = min(breaker['backoff'] * 2, self.breaker_backoff_max)
+                    breaker['next_probe'] = loop.time() + breaker['backoff']
+
+    @property
+    def connected(self) -> bool:
+        return self.transport is not None and not self.transport.is_closing()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await create_serial_connection(loop, make_protocol, self.port,
+                                                                       baudrate=self.baudrate, parity=self.parity,
+                                                                       stopbits=self.stopbits, timeout=0.1)
+        logger.info(f'Serial port {self.port} opened')
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+        self.protocol = None
+
+    async def _ensure_connected(self):
+        if self.connected:
+            return
+        self.close()
+        try:
+            await self.connect()
+        except Exception as e:
+            self.close()
+            await asyncio.sleep(self.reconnect_delay)  # do not hammer the tty while adapter is away
+            raise BusError(f'Unable open serial port {self.port} - {e}')
+
+    def _set_stopbits(self, stopbits: Union[int, None]):
+        stopbits = stopbits or self.stopbits
+        if self.transport.serial.stopbits != stopbits:
+            self.transport.serial.stopbits = stopbits
+
+    async def start(self):
+        try:
+            await self._ensure_connected()
+        except BusError as e:
+            logger.error(e)  # not fatal, worker will try again on the first job
+        self._ready = asyncio.Event()
+        self._worker = asyncio.create_task(self._run())
+        self._prober = asyncio.create_task(self._probe_units())
+
+    async def stop(self):
+        for task in (self._worker, self._prober):
+            if task:
+                task.cancel()
+        self.close()
+
+    async def execute(self, job: Callable[[BusClient], Awaitable], stopbits: Union[int, None] = None,
+                      priority: int = PRIORITY_READ):
+        """
+        Put job to the bus queue and wait result. Job is a coroutine function which get BusClient as argument.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.lanes[priority].append((loop.time(), job, stopbits, future))
+        if self._ready is not None:  # before start() job just waits in the lane
+            self._ready.set()
+        return await future
+
+    def stats(self) -> dict:
+        """
+        Queue depth and wait time (seconds) for every priority class
+        """
+        stats = {name: {'depth': len(self.lanes[priority]), **self.waits[priority]}
+                 for priority, name in enumerate(PRIORITY_NAMES)}
+        stats['breakers'] = {unit: {'state': self.breaker_state(unit), 'failures': breaker['failures']}
+                             for unit, breaker in self.breakers.items()}
+        return stats
+
+    def _next_job(self, now: float) -> Union[tuple, None]:
+        background = self.lanes[PRIORITY_BACKGROUND]
+        if background and now - background[0][0] > self.background_max_wait:
+            return PRIORITY_BACKGROUND, background.popleft()
+        for priority, lane in enumerate(self.lanes):
+            if lane:
+                return priority, lane.popleft()
+        return None
+
+    def _account_wait(self, priority: int, wait: float):
+        metrics.observe('modbus_queue_wait_seconds', wait, bus=self.name, priority=PRIORITY_NAMES[priority])
+        stat = self.waits[priority]
+        stat['jobs'] += 1
+        stat['wait_avg'] = stat['wait_avg'] * 0.9 + wait * 0.1
+        stat['wait_max'] = max(stat['wait_max'], wait)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            next_job = self._next_job(loop.time())
+            if next_job is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            priority, (queued, job, stopbits, future) = next_job
+            if future.cancelled():  # nobody waits this result anymore
+                continue
+            started = loop.time()
+            self._account_wait(priority, started - queued)
+            try:
+                await self._ensure_connected()
+                self._set_stopbits(stopbits)
+                result = await job(self.client)
+            except Exception as e:
+                logger.error(f'Bus {self.port} job failed - {e}')
+                if not future.cancelled():
+                    future.set_exception(e)
+                continue
+            finally:
+                metrics.inc('modbus_bus_busy_seconds_total', loop.time() - started, bus=self.name)
+            if not future.cancelled():
+                future.set_result(result)
+
+
+class BusRegistry:
+    """
+    All RS-485 adapters of the controller, every one with own serial settings and own worker.
+    Buses are described as "name=port:baudrate:parity:stopbits, ..." and units are mapped to buses as
+    "unit_id=name, ..." (or "profile=name" for device profiles like pzem). Not mapped units go to the first bus.
+    """
+
+    def __init__(self, buses: str, units: str = '', **bus_options):
+        self.buses = {}
+        for bus_conf in buses.split(','):
+            if not bus_conf.strip():
+                continue
+            name, settings = bus_conf.split('=', 1)
+            port, baudrate, parity, stopbits = (settings.strip().split(':') + ['9600', 'N', '1'])[:4]
+            self.buses[name.strip()] = ModbusBus(port, baudrate=int(baudrate), parity=parity.upper(),
+                                                 stopbits=int(stopbits), name=name.strip(), **bus_options)
+        self.default = next(iter(self.buses.values()))
+        metrics.gauge('modbus_queue_depth', self.queue_depth)
+        self.units = {}
+        for unit_conf in units.split(','):
+            if not unit_conf.strip():
+                continue
+            unit, name = unit_conf.split('=', 1)
+            self.units[unit.strip()] = self.buses[name.strip()]
+
+    def for_unit(self, unit: Union[int, str]) -> ModbusBus:
+        return self.units.get(str(unit), self.default)
+
+    def has_own_bus(self, unit: Union[int, str]) -> bool:
+        return str(unit) in self.units
+
+    async def start(self):
+        for bus in self.buses.values():
+            await bus.start()
+
+    async def stop(self):
+        for bus in self.buses.values():
+            await bus.stop()
+
+    def stats(self) -> dict:
+        return {name: bus.stats() for name, bus in self.buses.items()}
+
+    def queue_depth(self) -> dict:
+        return {(('bus', name), ('priority', PRIORITY_NAMES[priority])): len(lane)
+                for name, bus in self.buses.items() for priority, lane in enumerate(bus.lanes)}
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+import json
+from asyncio_mqtt import Client, MqttError
+from loguru import logger
+
+
+class MqttPublisher:
+    """
+    One long-lived connection to the broker, messages go through the bounded queue
+    so publishing never blocks the caller (and the Modbus bus).
+    """
+
+    def __init__(self, host: str, client_id: str = 'hw-ctrl', queue_size: int = 1000, reconnect_interval: float = 5):
+        self.host = host
+        self.client_id = client_id
+        self.reconnect_interval = reconnect_interval
+        self.queue_size = queue_size
+        self.queue = None  # asyncio.Queue, created in start() - on the loop which serves requests
+        self._worker = None
+
+    def publish(self, topic: str, payload: dict):
+        if not self.host or self.queue is None:  # MQTT is not configured or publisher is not started
+            return
+        try:
+            self.queue.put_nowait((topic, payload))
+        except asyncio.QueueFull:
+            logger.warning(f'MQTT queue is full, drop message to {topic}')
+
+    async def start(self):
+        if self.host:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                async with Client(self.host, clean_session=True, client_id=self.client_id) as client:
+                    while True:
+                        topic, payload = await self.queue.get()
+                        await client.publish(topic, payload=json.dumps(payload).encode())
+            except MqttError as e:
+                logger.error(f'MQTT publisher error "{e}". Reconnecting in {self.reconnect_interval} seconds.')
+            await asyncio.sleep(self.reconnect_interval)
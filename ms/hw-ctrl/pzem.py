@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+import time
+from array import array
+from bisect import bisect_left
+from operator import add, mul, sub
+from typing import Awaitable, Callable, Union
+from loguru import logger
+
+FIELDS = ('voltage', 'amp', 'power')
+PERIODS = {'1m': 60, '5m': 300, '1h': 3600}
+
+
+class RingBuffer:
+    """
+    Fixed size history of PZEM samples. Every field is a separate array of doubles,
+    so rollups work with array slices and builtins (min/max/sum/map) instead of python loops over dicts.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.pos = 0
+        self.count = 0
+        self.data = {name: array('d', bytes(8 * size)) for name in ('ts',) + FIELDS}
+
+    def append(self, ts: float, **values):
+        self.data['ts'][self.pos] = ts
+        for name in FIELDS:
+            self.data[name][self.pos] = values[name]
+        self.pos = (self.pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def ordered(self, name: str) -> array:
+        """
+        Field values from the oldest to the newest sample
+        """
+        values = self.data[name]
+        if self.count < self.size:
+            return values[:self.count]
+        return values[self.pos:] + values[:self.pos]
+
+
+def energy_wh(ts: array, power: array, max_gap: float = 0) -> float:
+    """
+    Trapezoidal integration of power (W) over time (s), result in Wh.
+    Steps not shorter than max_gap (sampler was stopped, PZEM did not answer) are skipped.
+    """
+    if len(ts) < 2:
+        return 0.0
+    steps, powers = map(sub, ts[1:], ts[:-1]), map(add, power[1:], power[:-1])
+    if not max_gap:
+        return sum(map(mul, steps, powers)) / 2 / 3600
+    return sum(step * both for step, both in zip(steps, powers) if step < max_gap) / 2 / 3600
+
+
+class PzemSampler:
+    """
+    Read PZEM with fixed rate in background, keep history in RingBuffer and integrate energy
+    """
+
+    def __init__(self, read: Callable[[], Awaitable[dict]], interval: float = 1, size: int = 21600):
+        self.read = read
+        self.interval = interval
+        self.history = RingBuffer(size)
+        self.latest = None
+        self.latest_ts = 0.0
+        self.max_gap = interval * 5  # do not integrate over the gaps
+        self.energy_wh = 0.0  # integrated since service start
+        self._worker = None
+
+    async def start(self):
+        if self.interval > 0:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+
+    def fresh(self) -> Union[dict, None]:
+        if self.latest is None or time.time() - self.latest_ts > self.interval * 2:
+            return None
+        return self.latest
+
+    def add_sample(self, ts: float, data: dict):
+        if self.latest is not None and ts - self.latest_ts < self.max_gap:
+            self.energy_wh += (self.latest['power'] + data['power']) / 2 * (ts - self.latest_ts) / 3600
+        self.history.append(ts, **data)
+        self.latest = data
+        self.latest_ts = ts
+
+    async def _run(self):
+        while True:
+            started = time.time()
+            try:
+                result = await self.read()
+            except Exception as e:
+                logger.error(f'PZEM sample failed - {e}')
+                result = {'error': True}
+            if not result['error']:
+                self.add_sample(time.time(), result['data'])
+            await asyncio.sleep(max(self.interval - (time.time() - started), 0))
+
+    def rollups(self, period: int, span: Union[int, None] = None) -> list:
+        """
+        Min/max/avg of voltage, current and power in 'period' seconds buckets (for the last 'span' seconds).
+        Energy of the step between samples goes to the bucket of its later sample, so buckets add up to the total.
+        """
+        ts = self.history.ordered('ts')
+        if not ts:
+            return []
+        fields = {name: self.history.ordered(name) for name in FIELDS}
+        start = ts[-1] - span if span else ts[0]
+        bucket_start = start - start % period
+        result = []
+        while bucket_start <= ts[-1]:
+            left, right = bisect_left(ts, bucket_start), bisect_left(ts, bucket_start + period)
+            if right > left:
+                first = max(left - 1, 0)  # step from the previous bucket
+                bucket = {'ts': bucket_start, 'samples': right - left,
+                          'energy_wh': round(energy_wh(ts[first:right], fields['power'][first:right], self.max_gap), 3)}
+                for name, values in fields.items():
+                    chunk = values[left:right]
+                    bucket[name] = {'min': round(min(chunk), 2), 'max': round(max(chunk), 2),
+                                    'avg': round(sum(chunk) / len(chunk), 2)}
+                result.append(bucket)
+            bucket_start += period
+        return result
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+import copy
+import time
+from typing import Awaitable, Callable
+from loguru import logger
+
+
+def parse_schedule(value: str) -> dict:
+    """
+    "sht3x_temp=60:120, 28-0215635abeff=30:90" -> {'sht3x_temp': (60.0, 120.0), ...} (period:max_age, seconds)
+    """
+    schedule = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        key, timing = item.split('=', 1)
+        period, max_age = (timing.split(':') + [''])[:2]
+        schedule[key.strip()] = (float(period), float(max_age or float(period) * 2))
+    return schedule
+
+
+class SensorSchedule:
+    """
+    Keep last value of every sensor in memory and refresh it in background every 'period' seconds.
+    Request is always answered from memory (stale-while-revalidate): if value is older than 'max_age'
+    refresh is started in background and caller gets what we have with its age. Only the very first
+    request of the sensor waits for the measurement.
+    """
+
+    def __init__(self, schedule: dict, default_period: float = 60, default_max_age: float = 120):
+        self.schedule = schedule
+        self.default_period = default_period
+        self.default_max_age = default_max_age
+        self.sensors = {}  # key -> {'read': ..., 'period': ..., 'max_age': ..., 'result': ..., 'ts': ..., 'task': ...}
+        self._workers = []
+        self._started = False
+
+    def add(self, key: str, read: Callable[[], Awaitable[dict]]) -> dict:
+        if key in self.sensors:  # already scheduled, one worker per sensor
+            return self.sensors[key]
+        period, max_age = self.schedule.get(key, (self.default_period, self.default_max_age))
+        sensor = self.sensors[key] = {'read': read, 'period': period, 'max_age': max_age,
+                                      'result': None, 'ts': 0.0, 'task': None}
+        if self._started:
+            self._start_worker(key)
+        return sensor
+
+    async def start(self):
+        self._started = True
+        for key in self.sensors:
+            self._start_worker(key)
+
+    async def stop(self):
+        self._started = False
+        for worker in self._workers:
+            worker.cancel()
+
+    def _start_worker(self, key: str):
+        if self.sensors[key]['period'] > 0:  # period 0 - refresh on demand only
+            self._workers.append(asyncio.create_task(self._run(key)))
+
+    async def _run(self, key: str):
+        sensor = self.sensors[key]
+        while True:
+            if time.time() - sensor['ts'] >= sensor['period']:
+                await self.refresh(key)
+            # after failed read 'ts' is not moved - try again not earlier than in the period
+            await asyncio.sleep(max(sensor['period'] - (time.time() - sensor['ts']), sensor['period'] / 4))
+
+    async def _read(self, key: str):
+        sensor = self.sensors[key]
+        try:
+            result = await sensor['read']()
+        except Exception as e:
+            logger.error(f'Sensor {key} read failed - {e}')
+            return
+        if result.get('error'):
+            if sensor['result'] is None:
+                sensor['result'] = result  # nothing better to answer yet
+            return  # keep the last good value, its age tells how old it is
+        sensor['result'] = result
+        sensor['ts'] = time.time()
+
+    async def refresh(self, key: str):
+        sensor = self.sensors[key]
+        if sensor['task'] is None or sensor['task'].done():
+            sensor['task'] = asyncio.create_task(self._read(key))
+        await asyncio.shield(sensor['task'])
+
+    async def get(self, key: str) -> dict:
+        """
+        Sensor value in format {'error': ..., 'data': {..., 'age': seconds}}. Only sensors added to
+        the schedule are answered - unknown key must not start a worker of its own.
+        """
+        sensor = self.sensors.get(key)
+        if sensor is None:
+            return {'error': True}
+        if sensor['result'] is None:
+            await self.refresh(key)
+        elif time.time() - sensor['ts'] > sensor['max_age'] and (sensor['task'] is None or sensor['task'].done()):
+            sensor['task'] = asyncio.create_task(self._read(key))
+        if sensor['result'] is None:
+            return {'error': True}
+        result = copy.deepcopy(sensor['result'])
+        if not result.get('error'):
+            result.setdefault('data', {})['age'] = round(time.time() - sensor['ts'], 1)
+        return result
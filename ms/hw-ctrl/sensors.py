@@ -2,6 +2,7 @@
 __author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
 
 import asyncio
+import struct
 from lruttl import LRUCache
 from pathlib import Path
 from fastapi import FastAPI, Response, status
@@ -11,8 +12,56 @@ from decouple import config # noqa
 from aiofile import LineReader, AIOFile
 from os.path import exists as file_exist
 from smbus2_asyncio import SMBus2Asyncio
+from singleflight import SingleFlight
 
 cache = LRUCache(64)  # 10 - глубина кэша
+single_flight = SingleFlight()
+
+
+class I2CBus:
+    """
+    One I2C bus handle for all sensors, opened on startup. Lock serialises bus transactions,
+    while sensor converts data (sleep between write and read) the bus is free for other sensors.
+    Handle and lock are created on the first use - on the loop which serves requests, nothing is done on import.
+    """
+
+    def __init__(self, bus_number: int = 1):
+        self.bus_number = bus_number
+        self.bus = None
+        self._lock = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def open(self):
+        async with self.lock:
+            if self.bus is None:
+                bus = SMBus2Asyncio(self.bus_number)
+                await bus.open()
+                self.bus = bus
+
+    async def close(self):
+        async with self.lock:
+            # SMBus2Asyncio has no close(), the file descriptor belongs to its SMBus
+            if self.bus is not None and self.bus.smbus is not None:
+                self.bus.smbus.close()
+            self.bus = None
+
+    async def write_i2c_block_data(self, address: int, register: int, data: list):
+        await self.open()
+        async with self.lock:
+            return await self.bus.write_i2c_block_data(address, register, data)
+
+    async def read_i2c_block_data(self, address: int, register: int, length: int) -> list:
+        await self.open()
+        async with self.lock:
+            return await self.bus.read_i2c_block_data(address, register, length)
+
+
+i2c_bus = I2CBus(config('I2C_BUS', default=1, cast=int))
 
 
 def format_result(res: dict) -> dict:
@@ -22,73 +71,217 @@ def format_result(res: dict) -> dict:
     return result
 
 
-async def sensor_sht3x(dh31_addr: int = 0x44, request_type: str = 'temp'):
+class SensorDriver:
     """
-    Read data from light sensor SHT3x (Temp + Humidity)
-    Address 0x44 (or 0x45)
+    Base I2C sensor driver: how to start measurement, how long to wait, what to read and how to decode.
+    Calibration (if chip has it) is read from the chip only once and kept in the driver.
     """
-    result = {'error': True}
+    name = ''
+    default_address = 0
+    measure_time = 0.0  # seconds between trigger and fetch
+    cache_ttl = 60
+    instances = {}  # value key -> Alice instance
+    sensor_types = {}  # sensor type (as in request) -> value key, by default "<name>_<key>"
 
-    cache_result_temp = cache.get('sht3x_temp')
-    if cache_result_temp and request_type == 'temp':
-        return format_result(cache_result_temp)
-    cache_result_hum = cache.get('sht3x_humidity')
-    if cache_result_hum and request_type != 'temp':
-        return format_result(cache_result_hum)
+    def __init__(self, address: Union[int, None] = None):
+        self.address = address or self.default_address
+        self.calibration = None
+        if not self.sensor_types:
+            self.sensor_types = {f'{self.name}_{key}': key for key in self.instances}
 
-    if cache.get('sensor_sht3x_lock'):  # block for flood requests
-        return result
-    cache.set('sensor_sht3x_lock', True, 1)
+    async def calibrate(self, bus: I2CBus) -> dict:
+        return {}
 
-    bus = SMBus2Asyncio(1)
-    await bus.open()
-    try:
-        await bus.write_i2c_block_data(dh31_addr, 0x2C, [0x06])  # read LOW resolution 2 words (for speed)
-    except Exception as e:
-        logger.error(f'Failed to open DH31x sensor - {e}')
-        return result
-    await asyncio.sleep(0.5)
-    raw_data = await bus.read_i2c_block_data(dh31_addr, 0x00, 6)
-    temp_raw = (raw_data[0] << 8 | raw_data[1])
-    humidity_raw = (raw_data[3] << 8 | raw_data[4])
-    temp = -45 + (175 * temp_raw / 65535.0)
-    humidity = 100 * humidity_raw / 65535.0
-    cache.set('sht3x_temp', {'value': float(f'{temp:.1f}'), 'instance': 'temperature', 'error': False}, 60)
-    cache.set('sht3x_humidity', {'value': int(humidity), 'instance': 'humidity', 'error': False}, 60)
+    async def trigger(self, bus: I2CBus):
+        pass
+
+    async def fetch(self, bus: I2CBus) -> bytes:
+        raise NotImplementedError
 
-    if request_type != 'temp':
-        return format_result(cache.get('sht3x_humidity'))
+    def decode(self, raw: bytes) -> dict:
+        raise NotImplementedError
 
-    return format_result(cache.get('sht3x_temp'))
+    async def measure(self, bus: I2CBus) -> dict:
+        if self.calibration is None:
+            self.calibration = await self.calibrate(bus)
+        await self.trigger(bus)
+        await asyncio.sleep(self.measure_time)
+        return self.decode(await self.fetch(bus))
 
 
-async def sensor_light():
+class SHT3x(SensorDriver):
     """
-    Read data from light sensor BH 1750
+    SHT3x (Temp + Humidity), address 0x44 (or 0x45)
     """
-    result = {'error': True}
-    if cache.get('sensor_light_lock'):  # block for flood requests
+    name = 'sht3x'
+    default_address = 0x44
+    measure_time = 0.5
+    instances = {'temp': 'temperature', 'humidity': 'humidity'}
+
+    async def trigger(self, bus: I2CBus):
+        await bus.write_i2c_block_data(self.address, 0x2C, [0x06])  # single shot, clock stretching
+
+    async def fetch(self, bus: I2CBus) -> bytes:
+        return bytes(await bus.read_i2c_block_data(self.address, 0x00, 6))
+
+    def decode(self, raw: bytes) -> dict:
+        temp_raw = (raw[0] << 8 | raw[1])
+        humidity_raw = (raw[3] << 8 | raw[4])
+        return {'temp': float(f'{-45 + (175 * temp_raw / 65535.0):.1f}'),
+                'humidity': int(100 * humidity_raw / 65535.0)}
+
+
+class BH1750(SensorDriver):
+    """
+    Light sensor BH1750, one time L-resolution mode
+    """
+    name = 'bh1750'
+    default_address = 0x23
+    measure_time = 0.1
+    cache_ttl = 30
+    instances = {'light': 'illumination'}
+    sensor_types = {'light': 'light', 'bh1750_light': 'light'}
+
+    async def trigger(self, bus: I2CBus):
+        await bus.read_i2c_block_data(self.address, 0x23, 2)  # read LOW resolution 2 words (for speed)
+
+    async def fetch(self, bus: I2CBus) -> bytes:
+        return bytes(await bus.read_i2c_block_data(self.address, 0x23, 2))
+
+    def decode(self, raw: bytes) -> dict:
+        return {'light': float(f'{(raw[0] << 8 | raw[1]) / 1.2:.1f}')}
+
+
+class BME280(SensorDriver):
+    """
+    BME280 (Temp + Humidity + Pressure) in forced mode, oversampling x1. All data registers are read
+    by one burst read, trimming parameters are read once. Pressure is in mm Hg.
+    """
+    name = 'bme280'
+    default_address = 0x76
+    measure_time = 0.01  # 1.25 + 3 * 2.3 + 2 * 0.575 ms max for oversampling x1
+    instances = {'temp': 'temperature', 'humidity': 'humidity', 'pressure': 'pressure'}
+    data_length = 8  # 0xF7..0xFE - press, temp, hum
+
+    async def calibrate(self, bus: I2CBus) -> dict:
+        raw = bytes(await bus.read_i2c_block_data(self.address, 0x88, 26))
+        calibration = dict(zip(('T1', 'T2', 'T3', 'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'P7', 'P8', 'P9'),
+                               struct.unpack('<HhhHhhhhhhhh', raw[:24])))
+        if 'humidity' in self.instances:
+            hum = bytes(await bus.read_i2c_block_data(self.address, 0xE1, 7))
+            calibration.update({
+                'H1': raw[25],
+                'H2': struct.unpack('<h', hum[0:2])[0],
+                'H3': hum[2],
+                'H4': (struct.unpack('b', hum[3:4])[0] << 4) | (hum[4] & 0x0F),
+                'H5': (struct.unpack('b', hum[5:6])[0] << 4) | (hum[4] >> 4),
+                'H6': struct.unpack('b', hum[6:7])[0],
+            })
+        return calibration
+
+    async def trigger(self, bus: I2CBus):
+        if 'humidity' in self.instances:
+            await bus.write_i2c_block_data(self.address, 0xF2, [0x01])  # humidity oversampling x1
+        await bus.write_i2c_block_data(self.address, 0xF4, [0x25])  # temp x1, pressure x1, forced mode
+
+    async def fetch(self, bus: I2CBus) -> bytes:
+        return bytes(await bus.read_i2c_block_data(self.address, 0xF7, self.data_length))
+
+    def decode(self, raw: bytes) -> dict:
+        cal = self.calibration
+        adc_p = (raw[0] << 12) | (raw[1] << 4) | (raw[2] >> 4)
+        adc_t = (raw[3] << 12) | (raw[4] << 4) | (raw[5] >> 4)
+
+        # Compensation formulas from the datasheet (double precision version)
+        var1 = (adc_t / 16384.0 - cal['T1'] / 1024.0) * cal['T2']
+        var2 = (adc_t / 131072.0 - cal['T1'] / 8192.0) ** 2 * cal['T3']
+        t_fine = var1 + var2
+        result = {'temp': float(f'{t_fine / 5120.0:.1f}')}
+
+        var1 = t_fine / 2.0 - 64000.0
+        var2 = var1 * var1 * cal['P6'] / 32768.0 + var1 * cal['P5'] * 2.0
+        var2 = var2 / 4.0 + cal['P4'] * 65536.0
+        var1 = (cal['P3'] * var1 * var1 / 524288.0 + cal['P2'] * var1) / 524288.0
+        var1 = (1.0 + var1 / 32768.0) * cal['P1']
+        pressure = 0.0
+        if var1:
+            pressure = (1048576.0 - adc_p - var2 / 4096.0) * 6250.0 / var1
+            pressure += (cal['P9'] * pressure * pressure / 2147483648.0 + pressure * cal['P8'] / 32768.0
+                         + cal['P7']) / 16.0
+        result['pressure'] = float(f'{pressure / 133.322:.1f}')  # Pa -> mm Hg
+
+        if 'humidity' in self.instances:
+            adc_h = (raw[6] << 8) | raw[7]
+            hum = t_fine - 76800.0
+            hum = (adc_h - (cal['H4'] * 64.0 + cal['H5'] / 16384.0 * hum)) * \
+                  (cal['H2'] / 65536.0 * (1.0 + cal['H6'] / 67108864.0 * hum * (1.0 + cal['H3'] / 67108864.0 * hum)))
+            hum = hum * (1.0 - cal['H1'] * hum / 524288.0)
+            result['humidity'] = int(min(max(hum, 0.0), 100.0))
         return result
-    if cache_result := cache.get('light_result'):
-        return format_result(cache_result)
 
-    cache.set('sensor_light_lock', True, 1)
-    light_address = 0x23
-    bus = SMBus2Asyncio(1)
-    await bus.open()
-    try:
 
-        await bus.read_i2c_block_data(light_address, 0x23, 2)  # read LOW resolution 2 words (for speed)
+class BMP280(BME280):
+    """
+    BMP280 - the same as BME280 without humidity
+    """
+    name = 'bmp280'
+    instances = {'temp': 'temperature', 'pressure': 'pressure'}
+    data_length = 6
+
+
+DRIVER_CLASSES = {driver.name: driver for driver in (SHT3x, BH1750, BME280, BMP280)}
+SENSORS = {}  # sensor type -> (driver, value key)
+
+
+def register_driver(driver: SensorDriver):
+    for sensor_type, key in driver.sensor_types.items():
+        SENSORS[sensor_type] = (driver, key)
+
+
+def register_drivers(drivers: str):
+    """
+    "sht3x=0x44, bh1750, bme280=0x77" - enabled drivers (with address if it is not default)
+    """
+    for item in drivers.split(','):
+        if not item.strip():
+            continue
+        name, address = (item.split('=', 1) + [''])[:2]
+        register_driver(DRIVER_CLASSES[name.strip()](int(address, 0) if address.strip() else None))
+
+
+def find_sensor(sensor_type: str) -> Union[str, None]:
+    """
+    Exact sensor type or the longest one which is part of request (topic like 'room_sht3x_temp')
+    """
+    if sensor_type in SENSORS:
+        return sensor_type
+    for name in sorted(SENSORS, key=len, reverse=True):
+        if name in sensor_type:
+            return name
+    return None
+
+
+async def measure(driver: SensorDriver) -> dict:
+    try:
+        values = await driver.measure(i2c_bus)
     except Exception as e:
-        logger.error(f'Failed to open light sensor - {e}')
+        logger.error(f'Failed to read {driver.name} sensor - {e}')
+        return {}
+    cache.set(f'{driver.name}_{driver.address}', values, driver.cache_ttl)
+    return values
+
+
+async def sensor_read(sensor_type: str, use_cache: bool = True) -> dict:
+    result = {'error': True}
+    if sensor_type not in SENSORS:
         return result
-    await asyncio.sleep(0.1)
-    raw_data = await bus.read_i2c_block_data(light_address, 0x23, 2)
-    lux = (raw_data[0] << 8 | raw_data[1]) / 1.2
-    result['value'] = float(f'{lux:.1f}')
-    result['instance'] = "illumination"
-    result['error'] = False
+    driver, key = SENSORS[sensor_type]
+    if not use_cache or not (values := cache.get(f'{driver.name}_{driver.address}')):
+        # Concurrent requests (temp and humidity too) wait the same measurement
+        values = await single_flight.do((driver.name, driver.address), lambda: measure(driver))
+        if not values:
+            return result
+    return format_result({'value': values[key], 'instance': driver.instances[key], 'error': False})
 
-    cache.set('light_result', result.copy(), 30)  # На 30 секунд кешируем результат
 
-    return format_result(result)
+register_drivers(config('I2C_SENSORS', default='sht3x, bh1750'))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Modbus RTU devices simulator over pseudo-terminal, for load tests of hw-ctrl without real hardware.
+
+Emulates 16 channel relay board, 16 input board and PZEM meter. Run it and use printed tty path as MODBUS_SERIAL:
+    python simulator.py --relay 1 --input 2 --pzem 5 --latency 0.01 --error-rate 0.01 --drop-rate 0.01
+"""
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import argparse
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+RELAY_ON, RELAY_OFF, RELAY_TOGGLE = 0x0100, 0x0200, 0x0300
+RELAY_ALL_ON, RELAY_ALL_OFF = 0x0700, 0x0800
+
+
+def crc16(data: bytes) -> bytes:
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack('<H', crc)
+
+
+class ModbusError(Exception):
+    def __init__(self, code: int):
+        self.code = code
+
+
+class RelayBoard:
+    """
+    16 channel relay board: channel N state is holding register N, command written to register N
+    (0x0100 on, 0x0200 off, 0x0300 toggle), 0x0700/0x0800 to register 0 - all on/all off
+    """
+
+    def __init__(self, channels: int = 16):
+        self.channels = [0] * channels
+
+    def read_holding(self, address: int, count: int) -> list:
+        return [self.read_register(reg) for reg in range(address, address + count)]
+
+    def read_register(self, reg: int) -> int:
+        if 1 <= reg <= len(self.channels):
+            return self.channels[reg - 1]
+        return 0
+
+    def read_input(self, address: int, count: int) -> list:
+        raise ModbusError(1)
+
+    def write(self, reg: int, value: int):
+        if reg == 0 and value in (RELAY_ALL_ON, RELAY_ALL_OFF):
+            self.channels = [int(value == RELAY_ALL_ON)] * len(self.channels)
+            return
+        if not 1 <= reg <= len(self.channels):
+            raise ModbusError(2)
+        if value == RELAY_ON:
+            self.channels[reg - 1] = 1
+        elif value == RELAY_OFF:
+            self.channels[reg - 1] = 0
+        elif value == RELAY_TOGGLE:
+            self.channels[reg - 1] ^= 1
+        else:
+            raise ModbusError(3)
+
+
+class InputBoard(RelayBoard):
+    """
+    16 input / 16 output board: outputs as relay board, input N is holding register 128 + N.
+    Inputs are flipped randomly with 'flip_rate' probability on every read.
+    """
+
+    def __init__(self, channels: int = 16, flip_rate: float = 0):
+        super().__init__(channels)
+        self.inputs = [0] * channels
+        self.flip_rate = flip_rate
+
+    def read_register(self, reg: int) -> int:
+        if 129 <= reg < 129 + len(self.inputs):
+            if random.random() < self.flip_rate:
+                self.inputs[reg - 129] ^= 1
+            return self.inputs[reg - 129]
+        return super().read_register(reg)
+
+
+class Pzem:
+    """
+    PZEM-017 DC meter: input registers 0..7 - voltage, current, power (2 regs), energy (2 regs), alarms
+    """
+
+    def __init__(self):
+        self.energy = 0.0
+        self.last = time.time()
+
+    def read_holding(self, address: int, count: int) -> list:
+        raise ModbusError(1)
+
+    def read_input(self, address: int, count: int) -> list:
+        voltage = 12 + random.uniform(-0.2, 0.2)
+        amp = 0.6 + random.uniform(-0.05, 0.05)
+        power = voltage * amp
+        now = time.time()
+        self.energy += power * (now - self.last) / 3600
+        self.last = now
+        power_raw, energy_raw = int(power * 10), int(self.energy)
+        registers = [int(voltage * 100), int(amp * 100), power_raw & 0xFFFF, power_raw >> 16,
+                     energy_raw & 0xFFFF, energy_raw >> 16, 0, 0]
+        return (registers + [0] * (address + count))[address:address + count]
+
+    def write(self, reg: int, value: int):
+        raise ModbusError(1)
+
+
+class ModbusSimulator:
+    def __init__(self, devices: dict, latency: float = 0, error_rate: float = 0, drop_rate: float = 0):
+        self.devices = devices
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.master, self.slave = os.openpty()  # slave fd stays open, otherwise master gets EIO between clients
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.frames = 0
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def handle(self, unit: int, fc: int, pdu: bytes) -> bytes:
+        device = self.devices[unit]
+        if fc in (3, 4):
+            address, count = struct.unpack('>HH', pdu[:4])
+            registers = device.read_holding(address, count) if fc == 3 else device.read_input(address, count)
+            return bytes([fc, 2 * count]) + struct.pack(f'>{count}H', *registers)
+        if fc == 6:
+            address, value = struct.unpack('>HH', pdu[:4])
+            device.write(address, value)
+            return bytes([fc]) + pdu[:4]
+        if fc == 16:
+            address, count = struct.unpack('>HH', pdu[:4])
+            for num, value in enumerate(struct.unpack(f'>{count}H', pdu[5:5 + 2 * count])):
+                device.write(address + num, value)
+            return bytes([fc]) + pdu[:4]
+        raise ModbusError(1)
+
+    def respond(self, frame: bytes):
+        unit, fc = frame[0], frame[1]
+        if unit not in self.devices or random.random() < self.drop_rate:
+            return  # nobody answers, master gets timeout
+        try:
+            if random.random() < self.error_rate:
+                raise ModbusError(4)
+            response = bytes([unit]) + self.handle(unit, fc, frame[2:-2])
+        except ModbusError as e:
+            response = bytes([unit, fc | 0x80, e.code])
+        if self.latency:
+            time.sleep(self.latency)
+        os.write(self.master, response + crc16(response))
+
+    def run(self):
+        buffer = b''
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                buffer = b''  # silent interval - frame is over
+                continue
+            buffer += os.read(self.master, 256)
+            while len(buffer) >= 8:
+                length = 8
+                if buffer[1] == 16:
+                    length = 9 + buffer[6]
+                if len(buffer) < length:
+                    break
+                frame, buffer = buffer[:length], buffer[length:]
+                if crc16(frame[:-2]) != frame[-2:]:
+                    buffer = b''  # lost sync, wait for the next frame
+                    break
+                self.frames += 1
+                self.respond(frame)
+
+
+def make_devices(relay: list, inputs: list, pzem: list, flip_rate: float = 0) -> dict:
+    devices = {unit: RelayBoard() for unit in relay}
+    devices.update({unit: InputBoard(flip_rate=flip_rate) for unit in inputs})
+    devices.update({unit: Pzem() for unit in pzem})
+    return devices
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--relay', type=int, nargs='*', default=[1], help='Relay boards unit ids')
+    parser.add_argument('--input', type=int, nargs='*', default=[2], help='Input boards unit ids')
+    parser.add_argument('--pzem', type=int, nargs='*', default=[5], help='PZEM meters unit ids')
+    parser.add_argument('--latency', type=float, default=0.01, help='Device response latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of Modbus exception responses')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Share of requests without response')
+    parser.add_argument('--flip-rate', type=float, default=0, help='Chance of input change on every read')
+
+
+def simulator_from_args(args: argparse.Namespace) -> ModbusSimulator:
+    return ModbusSimulator(make_devices(args.relay, args.input, args.pzem, args.flip_rate),
+                           latency=args.latency, error_rate=args.error_rate, drop_rate=args.drop_rate)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Modbus RTU devices simulator over pty')
+    add_arguments(arg_parser)
+    simulator = simulator_from_args(arg_parser.parse_args())
+    print(f'Simulator is ready, MODBUS_SERIAL={simulator.port}', flush=True)
+    try:
+        simulator.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+import copy
+from typing import Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical requests: while the call with the same key is in flight,
+    new callers wait for it and get its result (every caller gets own copy of result).
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key, None) if self.calls.get(key) is f else None)
+        # shield - cancelled caller must not cancel the call other callers are waiting for
+        return copy.deepcopy(await asyncio.shield(future))
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests of hw-ctrl modules, run from this directory:
+    python -m unittest tests
+"""
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+import time
+import unittest
+
+from board_state import BoardState, InputWatcher
+from modbus_bus import ModbusBus, UnitUnreachable, PRIORITY_WRITE, PRIORITY_READ, PRIORITY_BACKGROUND
+from pzem import PzemSampler, energy_wh
+from sensor_schedule import SensorSchedule, parse_schedule
+from simulator import ModbusSimulator, make_devices
+from singleflight import SingleFlight
+
+
+class SlowSimulator(ModbusSimulator):
+    """
+    Every 'slow_every' answer comes 'slow' seconds later
+    """
+
+    def __init__(self, *args, slow: float = 0, slow_every: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slow = slow
+        self.slow_every = slow_every
+
+    def respond(self, frame: bytes):
+        if self.slow_every and (self.frames % self.slow_every) == 0:
+            time.sleep(self.slow)
+        super().respond(frame)
+
+
+class BusLanesTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = ModbusBus('/dev/null', background_max_wait=2)
+
+    def queue(self, priority: int, queued: float, name: str):
+        self.bus.lanes[priority].append((queued, name, None, None))
+
+    def test_most_important_lane_first(self):
+        self.queue(PRIORITY_BACKGROUND, 10, 'poll')
+        self.queue(PRIORITY_READ, 10.5, 'read')
+        self.queue(PRIORITY_WRITE, 11, 'write')
+        order = [self.bus._next_job(11)[1][1] for _ in range(3)]  # noqa
+        self.assertEqual(order, ['write', 'read', 'poll'])
+        self.assertIsNone(self.bus._next_job(11))  # noqa
+
+    def test_background_is_not_starved(self):
+        self.queue(PRIORITY_BACKGROUND, 10, 'poll')
+        self.queue(PRIORITY_BACKGROUND, 11, 'poll2')
+        self.queue(PRIORITY_WRITE, 12, 'write')
+        self.assertEqual(self.bus._next_job(12.5)[1][1], 'poll')  # noqa  waits 2.5 s - goes first
+        self.assertEqual(self.bus._next_job(12.5)[1][1], 'write')  # noqa  only one at a time
+
+    def test_stats(self):
+        self.queue(PRIORITY_READ, 10, 'read')
+        self.bus._account_wait(PRIORITY_READ, 0.5)  # noqa
+        stats = self.bus.stats()
+        self.assertEqual(stats['interactive_read']['depth'], 1)
+        self.assertEqual(stats['interactive_read']['jobs'], 1)
+        self.assertEqual(stats['interactive_read']['wait_max'], 0.5)
+        self.assertEqual(stats['background']['depth'], 0)
+
+    def test_timing(self):
+        self.assertEqual(self.bus.frame_gap(), 0.1)
+        self.assertEqual(self.bus.response_timeout(1, 8, 37), 0.7)
+        self.bus.timing = 'auto'
+        self.assertAlmostEqual(self.bus.frame_gap(), 3.5 * 10 / 9600)
+        self.assertEqual(self.bus.response_timeout(1, 8, 37), 0.7)  # latency of the unit is not known yet
+        self.bus.learn_latency(1, 0.003)
+        self.assertEqual(self.bus.response_timeout(1, 8, 37), 0.35)  # not shorter than half of configured
+        self.bus.learn_latency(2, 0.3)
+        self.assertEqual(self.bus.response_timeout(2, 8, 37), 0.7)
+
+
+class BusBreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_breaker_opens_and_closes(self):
+        bus = ModbusBus('/dev/null', breaker_failures=3)
+        for _ in range(2):
+            bus.record_result(1, False)
+        self.assertEqual(bus.breaker_state(1), 'closed')
+        bus.record_result(1, False)
+        self.assertEqual(bus.breaker_state(1), 'open')
+        self.assertEqual(bus.stats()['breakers'][1], {'state': 'open', 'failures': 3})
+        bus.record_result(1, True)
+        self.assertEqual(bus.breaker_state(1), 'closed')
+        self.assertEqual(bus.breakers[1]['failures'], 0)
+
+
+class SimulatorCase(unittest.IsolatedAsyncioTestCase):
+    """
+    Bus against pty simulator: relay board 1, register N holds 100 + N
+    """
+
+    async def asyncSetUp(self):
+        devices = make_devices([1], [], [])
+        devices[1].channels = list(range(101, 117))
+        self.simulator = self.make_simulator(devices).start()
+        self.bus = ModbusBus(self.simulator.port, timing='auto', timeout=0.2, breaker_failures=2, breaker_backoff=60)
+        await self.bus.start()
+
+    async def asyncTearDown(self):
+        await self.bus.stop()
+        self.simulator.stop()
+
+    def make_simulator(self, devices: dict) -> ModbusSimulator:
+        return ModbusSimulator(devices, latency=0.002)
+
+    async def read(self, reg: int, unit: int = 1) -> int:
+        response = await self.bus.execute(lambda client: client.read_holding_registers(reg, 1, unit=unit))
+        return response.registers[0]
+
+    async def read_error(self, reg: int, unit: int = 1):
+        """
+        Type of exception (not assertRaises - it clears frames of the traceback, the frame of bus worker too)
+        """
+        try:
+            await self.read(reg, unit)
+        except Exception as e:
+            return type(e)
+        return None
+
+
+class BusSimulatorTest(SimulatorCase):
+    async def test_read(self):
+        self.assertEqual([await self.read(reg) for reg in (1, 5, 16)], [101, 105, 116])
+        self.assertIn(1, self.bus.latency)
+
+    async def test_unreachable_unit_fails_fast(self):
+        self.assertEqual([await self.read_error(1, unit=7) for _ in range(2)], [asyncio.TimeoutError] * 2)
+        started = time.monotonic()
+        self.assertIs(await self.read_error(1, unit=7), UnitUnreachable)
+        self.assertLess(time.monotonic() - started, 0.05)
+        self.assertEqual(await self.read(2), 102)  # other units are not affected
+
+
+class BusLateAnswerTest(SimulatorCase):
+    """
+    Late answer of timed out request must not be taken as the answer of the next one
+    """
+
+    def make_simulator(self, devices: dict) -> ModbusSimulator:
+        return SlowSimulator(devices, latency=0.002, slow=0.15, slow_every=3)
+
+    async def test_late_answer_is_dropped(self):
+        self.bus.breaker_failures = 100
+        await self.read(1)  # latency is learned, timeout is 0.1 s (half of configured) from now
+        answers, errors = [], []
+        for num in range(12):
+            try:
+                answers.append((num % 16 + 1, await self.read(num % 16 + 1)))
+            except Exception as e:
+                errors.append(type(e))
+        self.assertEqual(errors, [asyncio.TimeoutError] * 4)
+        self.assertEqual([value - 100 for reg, value in answers], [reg for reg, value in answers])
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_one(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def read():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'status': [1, 0]}
+
+        results = await asyncio.gather(*[single_flight.do('board', read) for _ in range(5)])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'status': [1, 0]}] * 5)
+        results[0]['status'][0] = 0  # every caller has own copy
+        self.assertEqual(results[1]['status'], [1, 0])
+        await single_flight.do('board', read)
+        self.assertEqual(len(calls), 2)  # finished call is not reused
+
+
+class BoardStateTest(unittest.TestCase):
+    def test_changed_channels(self):
+        changes = []
+        state = BoardState(on_change=lambda kind, unit_id, channel, value, ts: changes.append((channel, value)))
+        self.assertEqual(state.update('relay', 1, [0, 0, 1]), [])
+        self.assertEqual(state.update('relay', 1, [1, 0, 0]), [1, 3])
+        self.assertEqual(changes, [(1, 1), (3, 0)])
+        self.assertEqual(state.channel('relay', 1, 1, max_age=5)['status'], 1)
+        self.assertIsNone(state.channel('relay', 1, 4, max_age=5))
+        self.assertIsNone(state.get('relay', 1, max_age=-1))
+
+    def test_input_edges(self):
+        edges = []
+        watcher = InputWatcher(None, [], lambda unit_id, channel, edge, ts: edges.append((channel, edge)))  # noqa
+        watcher.check(2, [0, 1, 0], 1.0)
+        watcher.check(2, [1, 0, 0], 2.0)
+        self.assertEqual(edges, [(1, 'rising'), (2, 'falling')])
+
+
+class SensorScheduleTest(unittest.IsolatedAsyncioTestCase):
+    def test_parse_schedule(self):
+        self.assertEqual(parse_schedule('sht3x_temp=60:120, 28-0215635abeff=30'),
+                         {'sht3x_temp': (60, 120), '28-0215635abeff': (30, 60)})
+
+    async def test_only_added_sensors(self):
+        schedule = SensorSchedule({})
+        self.assertEqual(await schedule.get('unknown'), {'error': True})
+        self.assertNotIn('unknown', schedule.sensors)
+
+        async def read():
+            return {'error': False, 'data': {'value': 21.5}}
+
+        schedule.add('w1', read)
+        self.assertIs(schedule.add('w1', read), schedule.sensors['w1'])  # one worker per sensor
+        result = await schedule.get('w1')
+        self.assertEqual(result['data']['value'], 21.5)
+        await schedule.stop()
+
+
+class PzemRollupTest(unittest.TestCase):
+    def setUp(self):
+        self.sampler = PzemSampler(read=None, interval=1, size=1000)  # noqa
+
+    def sample(self, ts: float, power: float):
+        self.sampler.add_sample(ts, {'voltage': 12.0, 'amp': power / 12, 'power': power})
+
+    def test_energy(self):
+        self.assertAlmostEqual(energy_wh([0, 1800, 3600], [10, 10, 10]), 10)
+        self.assertAlmostEqual(energy_wh([0, 3600], [0, 20]), 10)
+        self.assertEqual(energy_wh([0], [10]), 0)
+
+    def test_gap_is_not_integrated(self):
+        self.assertAlmostEqual(energy_wh([0, 1, 2, 100, 101], [3600] * 5, max_gap=5), 3)
+
+    def test_buckets_add_up_to_total(self):
+        for ts in range(0, 130):  # 1 s samples over two minute buckets
+            self.sample(1000 + ts, 36 + ts % 7)
+        for ts in range(300, 400):  # after outage of 170 s
+            self.sample(1000 + ts, 72)
+        buckets = self.sampler.rollups(60)
+        self.assertEqual(sum(bucket['samples'] for bucket in buckets), 230)
+        self.assertAlmostEqual(sum(bucket['energy_wh'] for bucket in buckets), self.sampler.energy_wh, places=2)
+        before, after = energy_wh(range(130), [36 + ts % 7 for ts in range(130)]), 72 * 99 / 3600
+        self.assertAlmostEqual(self.sampler.energy_wh, before + after)
+
+    def test_bucket_stats(self):
+        for ts in range(0, 60):
+            self.sample(600 + ts, 10 + ts)
+        bucket, = self.sampler.rollups(60)
+        self.assertEqual(bucket['ts'], 600)
+        self.assertEqual(bucket['samples'], 60)
+        self.assertEqual(bucket['power'], {'min': 10, 'max': 69, 'avg': 39.5})
+        self.assertEqual(bucket['voltage']['avg'], 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Nikolay Mamashin (mamashin@gmail.com)'
+
+import asyncio
+import copy
+import time
+from pathlib import Path
+from loguru import logger
+from singleflight import SingleFlight
+
+THERM_FAMILIES = ('10-', '22-', '28-', '3b-', '42-')  # DS18S20, DS1822, DS18B20, DS1825, DS28EA00
+
+
+class Wire1:
+    """
+    Bulk read of all 1-Wire thermometers: conversion is started on all sensors at once by the bus master
+    (therm_bulk_read of w1_therm driver), so 8 sensors take one ~750 ms conversion instead of eight.
+    Files are read in worker thread, result is kept for 'max_age' seconds. Devices list is cached too.
+    """
+
+    def __init__(self, root: str = '/sys/bus/w1/devices', list_ttl: float = 60, max_age: float = 5,
+                 conversion_time: float = 0.75):
+        self.root = Path(root)
+        self.list_ttl = list_ttl
+        self.max_age = max_age
+        self.conversion_time = conversion_time
+        self._devices = []
+        self._devices_ts = 0.0
+        self._result = {}
+        self._result_ts = 0.0
+        self._single_flight = SingleFlight()
+
+    def devices(self) -> list:
+        if time.time() - self._devices_ts > self.list_ttl:
+            try:
+                self._devices = sorted(path.name for path in self.root.iterdir() if path.name.startswith(THERM_FAMILIES))
+            except OSError as e:
+                logger.error(f'Unable list w1 devices - {e}')
+                self._devices = []
+            self._devices_ts = time.time()
+        return self._devices
+
+    def _convert(self):
+        triggered = []
+        for master in self.root.glob('w1_bus_master*'):
+            bulk = master / 'therm_bulk_read'
+            if bulk.exists():
+                bulk.write_text('trigger\n')
+                triggered.append(bulk)
+        if not triggered:
+            return  # old kernel - every device converts on its own read
+        time.sleep(self.conversion_time)
+        deadline = time.time() + self.conversion_time
+        # -1 - conversion is still in progress on some sensor
+        while any(bulk.read_text().strip() == '-1' for bulk in triggered) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def _read_device(self, device_id: str) -> dict:
+        """
+        Kernel with bulk read has 'temperature' file (millidegrees), old one - only w1_slave, looks like:
+         #cat /sys/bus/w1/devices/28-0215635abeff/w1_slave
+         9e 01 4b 46 7f ff 0c 10 8a : crc=8a YES
+         9e 01 4b 46 7f ff 0c 10 8a t=25875
+        """
+        result = {'error': True}
+        device = self.root / device_id
+        try:
+            if (device / 'temperature').exists():
+                temp = int((device / 'temperature').read_text().strip())
+            else:
+                lines = (device / 'w1_slave').read_text().splitlines()
+                if len(lines) < 2 or not lines[0].strip().endswith('YES'):
+                    logger.error(f'File temp info is corrupt - {lines}')
+                    return result
+                temp = int(lines[1][lines[1].find('t=') + 2:])
+        except (OSError, ValueError) as e:
+            logger.error(f'Error to read temp of {device_id} - {e}')
+            return result
+        result['value'] = float(f'{temp / 1000:.1f}')
+        result['instance'] = 'temperature'
+        result['error'] = False
+        return result
+
+    def _read_all_sync(self) -> dict:
+        devices = self.devices()
+        if devices:
+            self._convert()
+        return {device_id: self._read_device(device_id) for device_id in devices}
+
+    async def _read_all(self) -> dict:
+        self._result = await asyncio.to_thread(self._read_all_sync)
+        self._result_ts = time.time()
+        return self._result
+
+    async def read_all(self) -> dict:
+        """
+        All thermometers {device_id: {'error': ..., 'value': ..., 'instance': 'temperature'}}
+        """
+        if time.time() - self._result_ts > self.max_age:
+            await self._single_flight.do('bulk', self._read_all)
+        return copy.deepcopy(self._result)
+
+    async def read(self, device_id: str) -> dict:
+        if device_id not in self.devices():
+            logger.error(f"w1 device not found - {device_id}")
+            return {'error': True}
+        return (await self.read_all()).get(device_id, {'error': True})
@@ -11,6 +11,12 @@ import json
 from decouple import config  # noqa
 
 DEBUG = config('MQTT_DEBUG', default=False, cast=bool)
+WORKERS = config('MQTT_WORKERS', default=4, cast=int)  # parallel posts to Django (different topics)
+QUEUE_SIZE = config('MQTT_QUEUE_SIZE', default=100, cast=int)  # messages waiting per worker
+STATS_INTERVAL = config('MQTT_STATS_INTERVAL', default=60, cast=int)  # seconds, 0 - do not publish stats
+BATCH_SIZE = config('MQTT_BATCH_SIZE', default=1, cast=int)  # messages per post to Django, 1 - no batching
+BATCH_LINGER = config('MQTT_BATCH_LINGER_MS', default=5, cast=int) / 1000  # wait for more messages of a batch
+TOPICS_RELOAD = config('MQTT_TOPICS_RELOAD', default=30, cast=int)  # seconds between topic list checks
 STOP = asyncio.Event()
 
 logger.remove()
@@ -25,45 +31,207 @@ async def mqtt_publish(topic, payload):
         logger.error(f"Error publish to MQTT - {e}")
 
 
-async def post_raw_mqtt(topic, payload) -> dict:
+async def post_raw_mqtt(http_client: httpx.AsyncClient, topic, payload) -> dict:
     result = {}
     post_data = {'topic': topic, 'payload': payload}
-    async with httpx.AsyncClient() as client:
+    try:
+        http_response = await http_client.post(f'{config("MQTT_API_BASE_URL")}/rawmqtt/', data=post_data)
+    except Exception as e:
+        logger.error(f'Unable post raw mqtt to {config("MQTT_API_BASE_URL")} - {e}')
+        return result
+    if http_response.status_code != 200:
+        logger.warning(f"Post result error - '{http_response.text}'")
+        return result
+    response_json = http_response.json()
+    if DEBUG:
+        logger.info(f'Response from MQTT-DB - {response_json}')
+    return response_json
+
+
+def decode_payload(payload: str):
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return payload
+
+
+async def post_raw_mqtt_batch(http_client: httpx.AsyncClient, batch: list) -> list:
+    """
+    List of (topic, payload) in one post, result - list of answers in the same order
+    """
+    post_data = [{'topic': topic, 'payload': decode_payload(payload)} for topic, payload in batch]
+    try:
+        http_response = await http_client.post(f'{config("MQTT_API_BASE_URL")}/rawmqtt/batch/', json=post_data)
+    except Exception as e:
+        logger.error(f'Unable post raw mqtt batch to {config("MQTT_API_BASE_URL")} - {e}')
+        return []
+    if http_response.status_code != 200:
+        logger.warning(f"Post batch result error - '{http_response.text}'")
+        return []
+    response_json = http_response.json()
+    if DEBUG:
+        logger.info(f'Response from MQTT-DB for {len(batch)} messages - {response_json}')
+    return response_json
+
+
+class Dispatcher:
+    """
+    Messages are posted to Django by the pool of workers. Topic always goes to the same worker,
+    so order of messages of one topic is kept and slow answer for one topic does not delay others.
+    Worker queues are bounded - if Django is too slow, reading from MQTT waits.
+    With batch_size > 1 worker collects up to batch_size messages, waiting for the next one not longer
+    than 'linger' seconds, and posts them in one request (burst of a scene is one post, not dozens).
+    """
+
+    def __init__(self, http_client: httpx.AsyncClient, workers: int = 4, queue_size: int = 100,
+                 batch_size: int = 1, linger: float = 0.005):
+        self.http_client = http_client
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processed = [0] * workers
+        self.posts = [0] * workers
+        self._workers = []
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker(num)) for num in range(len(self.queues))]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+
+    async def put(self, topic, payload):
+        await self.queues[hash(topic) % len(self.queues)].put((topic, payload))
+
+    async def _collect(self, queue: asyncio.Queue) -> list:
+        batch = [await queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.linger
+        while len(batch) < self.batch_size:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self, num: int):
+        queue = self.queues[num]
+        while True:
+            batch = await self._collect(queue)
+            try:
+                if len(batch) == 1:
+                    await post_raw_mqtt(self.http_client, *batch[0])
+                else:
+                    await post_raw_mqtt_batch(self.http_client, batch)
+            except Exception as e:
+                logger.error(f'Dispatch of {[topic for topic, _ in batch]} failed - {e}')
+            self.processed[num] += len(batch)
+            self.posts[num] += 1
+
+    def stats(self) -> dict:
+        return {'queue_depth': [queue.qsize() for queue in self.queues], 'processed': self.processed,
+                'posts': self.posts}
+
+
+class TopicIndex:
+    """
+    Topics which Django can route (from /api/mqtt/topics/). While the list is unknown - everything is routable
+    and we listen "#" as before.
+    """
+
+    def __init__(self, http_client: httpx.AsyncClient):
+        self.http_client = http_client
+        self.version = None
+        self.topics = None
+
+    def routable(self, topic: str) -> bool:
+        return self.topics is None or topic in self.topics
+
+    async def fetch(self) -> bool:
+        """
+        Reload topic list, True if it is changed
+        """
         try:
-            http_response = await client.post(f'{config("MQTT_API_BASE_URL")}/rawmqtt/', data=post_data,
-                                              headers={'Connection': 'close'})
+            http_response = await self.http_client.get(f'{config("MQTT_API_BASE_URL")}/mqtt/topics/')
+            http_response.raise_for_status()
+            response_json = http_response.json()
         except Exception as e:
-            logger.error(f'Unable post raw mqtt to {config("MQTT_API_BASE_URL")} - {e}')
-            return result
-        if http_response.status_code != 200:
-            logger.warning(f"Post result error - '{http_response.text}'")
-            return result
-        response_json = http_response.json()
+            logger.error(f'Unable get topics list from {config("MQTT_API_BASE_URL")} - {e}')
+            return False
+        if response_json['version'] == self.version:
+            return False
+        self.version = response_json['version']
+        self.topics = frozenset(response_json['topics'])
+        logger.info(f'Routable topics list is loaded, version {self.version}, {len(self.topics)} topics')
+        return True
+
+
+async def sync_subscriptions(client: Client, index: TopicIndex, subscribed: set):
+    """
+    Subscribe to new topics of the index and unsubscribe from removed ones ("#" if index is not loaded)
+    """
+    wanted = set(index.topics) if index.topics is not None else {'#'}
+    if removed := list(subscribed - wanted):
+        await client.unsubscribe(removed)
+    if added := list(wanted - subscribed):
+        await client.subscribe([(topic, 0) for topic in added])
+    subscribed.clear()
+    subscribed.update(wanted)
+
+
+async def reload_topics(client: Client, index: TopicIndex, subscribed: set):
+    while True:
+        await asyncio.sleep(TOPICS_RELOAD)
+        if await index.fetch():
+            await sync_subscriptions(client, index, subscribed)
+
+
+async def publish_stats(client: Client, dispatcher: Dispatcher):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        stats = dispatcher.stats()
         if DEBUG:
-            logger.info(f'Response from MQTT-DB - {response_json}')
-        return response_json
+            logger.info(f'Dispatcher stats - {stats}')
+        await client.publish("mqtt_sub/stats", payload=json.dumps(stats).encode())
 
 
-async def mqtt_sub():
+async def mqtt_sub(dispatcher: Dispatcher, index: TopicIndex):
     logger.info(f'Ready to listen topics from mqtt broker - {config("MQTT_HOST")}')
     async with Client(config("MQTT_HOST"), clean_session=True, client_id="My_IoT_Subscribe") as client:
-        async with client.unfiltered_messages() as messages:  # Receive all messages
-            await client.subscribe("#")  # Tell the server to send me all messages
-            async for message in messages:
-                if DEBUG:
-                    logger.info(f"{message.topic} - {message.payload}")
+        subscribed = set()
+        tasks = [asyncio.create_task(reload_topics(client, index, subscribed))]
+        if STATS_INTERVAL:
+            tasks.append(asyncio.create_task(publish_stats(client, dispatcher)))
+        try:
+            async with client.unfiltered_messages() as messages:  # Receive all messages
+                await index.fetch()
+                await sync_subscriptions(client, index, subscribed)  # Only topics Django knows (or all)
+                async for message in messages:
+                    if not index.routable(message.topic):  # cheap check before touching payload
+                        continue
+                    if DEBUG:
+                        logger.info(f"{message.topic} - {message.payload}")
 
-                if message.topic == "rc_code":  # Если это команда с RC (пульта) переключаемся на отдельный обработчик
-                    await post_raw_mqtt(message.topic, message.payload.decode())
-                    continue
+                    if message.topic == "rc_code":  # Если это команда с RC (пульта) переключаемся на отдельный обработчик
+                        await dispatcher.put(message.topic, message.payload.decode())
+                        continue
 
-                try:
-                    payload_json = json.loads(message.payload.decode())
-                except Exception as e:
-                    logger.error(f'Cant parse payload to json - {message.payload.decode()} ({e}')
-                    continue
-                if payload_json.get('cmd'):
-                    await post_raw_mqtt(message.topic, message.payload.decode())
+                    try:
+                        payload_json = json.loads(message.payload.decode())
+                    except Exception as e:
+                        logger.error(f'Cant parse payload to json - {message.payload.decode()} ({e}')
+                        continue
+                    # Only commands go to Django, state echoes (group/topic, any JSON without cmd) are dropped here
+                    if isinstance(payload_json, dict) and payload_json.get('cmd'):
+                        await dispatcher.put(message.topic, message.payload.decode())
+        finally:
+            for task in tasks:
+                task.cancel()
 
 
 def sig_int(*args):
@@ -74,13 +242,19 @@ def sig_int(*args):
 
 async def main_task():
     reconnect_interval = 30  # [seconds]
-    while True:
-        try:
-            await mqtt_sub()
-        except MqttError as error:
-            logger.error(f'Error "{error}". Reconnecting in {reconnect_interval} seconds.')
-        finally:
-            await asyncio.sleep(reconnect_interval)
+    # One pooled keep-alive client for all posts to Django
+    limits = httpx.Limits(max_connections=WORKERS, max_keepalive_connections=WORKERS)
+    async with httpx.AsyncClient(limits=limits, timeout=10) as http_client:
+        dispatcher = Dispatcher(http_client, WORKERS, QUEUE_SIZE, BATCH_SIZE, BATCH_LINGER)
+        dispatcher.start()
+        index = TopicIndex(http_client)
+        while True:
+            try:
+                await mqtt_sub(dispatcher, index)
+            except MqttError as error:
+                logger.error(f'Error "{error}". Reconnecting in {reconnect_interval} seconds.')
+            finally:
+                await asyncio.sleep(reconnect_interval)
 
 
 # asyncio.run(main())